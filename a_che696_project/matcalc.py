@@ -8,118 +8,1794 @@ Solves systems of matrices using numerical methods
 Handles the primary functions
 """
 
+import os
 import sys
 import argparse
 import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+import scipy.sparse.csgraph as csgraph
+from scipy.linalg import solve_triangular, lu_factor, lu_solve, cho_factor, cho_solve, LinAlgError
 import math
+import hashlib
+import warnings
+import io
+import gzip
+import json
+import threading
+import queue
+from collections import namedtuple, OrderedDict
+import time
+
+_SPACE, _COMMA, _SEMICOLON = ord(" "), ord(","), ord(";")
+
+def parse_matrix(text):
+    """
+    Parses a matrix written as text, such as '1,2,3;4,5,6'. Rows are separated by ';' or by line breaks, and the
+    entries of a row by ',' or by whitespace; entries may use scientific notation ('1.5e-3').
+    The whole string is tokenized in one pass with vectorized operations and the numbers are converted straight
+    into one float64 buffer, so the cost grows linearly with the length of the text.
+    Returns a rows x columns array; raises ValueError for ragged rows, empty entries or entries that are not numbers.
+    """
+    chars = np.frombuffer(text.encode("ascii", "replace"), dtype=np.uint8).copy()
+    chars[chars == ord("\n")] = _SEMICOLON
+    chars[(chars == ord("\t")) | (chars == ord("\r")) | (chars == ord("\f")) | (chars == ord("\v"))] = _SPACE
+    # a separator at the very end (a trailing ';' or line break) does not start another row
+    last = len(chars)
+    while last > 0 and chars[last - 1] in (_SPACE, _SEMICOLON):
+        last -= 1
+    chars = chars[:last]
+    if last == 0:
+        raise ValueError("The matrix is empty")
+    row_ends = np.flatnonzero(chars == _SEMICOLON)
+    rows = len(row_ends) + 1
+    is_sep = (chars == _SPACE) | (chars == _COMMA) | (chars == _SEMICOLON)
+    starts = ~is_sep
+    starts[1:] &= is_sep[:-1] # the first character of every entry
+    # count the entries and commas of every row from their positions, without a per-character row index
+    entries = np.bincount(np.searchsorted(row_ends, np.flatnonzero(starts)), minlength=rows)
+    commas = np.bincount(np.searchsorted(row_ends, np.flatnonzero(chars == _COMMA)), minlength=rows)
+    empty = (entries == 0) | ((commas > 0) & (entries != commas + 1))
+    if np.any(empty):
+        raise ValueError("Row {} has an empty entry".format(int(np.flatnonzero(empty)[0]) + 1))
+    if np.any(entries != entries[0]):
+        ragged = int(np.flatnonzero(entries != entries[0])[0])
+        raise ValueError("Row {} has {} entries but row 1 has {}".format(ragged + 1, entries[ragged], entries[0]))
+    chars[is_sep] = _SPACE
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always") # np.fromstring warns, then stops, at the first entry it cannot read in full
+        values = np.fromstring(chars.tobytes(), dtype=np.float64, sep=" ")
+    if caught or values.size != entries.sum():
+        # the fast path stopped early, possibly in the middle of an entry such as '4x'; convert the entries one by
+        # one to find the one that is not a number
+        tokens = chars.tobytes().split()
+        values = np.empty(len(tokens))
+        for number, token in enumerate(tokens):
+            try:
+                values[number] = float(token)
+            except ValueError:
+                raise ValueError("Could not convert entry {} to a number: {!r}".format(number + 1, token.decode()))
+    return values.reshape(rows, entries[0])
+
+def _matrix_market_header(stream):
+    # Reads the banner, comments and size line of a Matrix Market file; returns the format, field and symmetry and
+    # the sizes, leaving `stream` at the first entry
+    banner = stream.readline().decode("ascii", "replace").lower().split()
+    if len(banner) != 5 or banner[0] != "%%matrixmarket" or banner[1] != "matrix":
+        raise ValueError("Not a Matrix Market matrix file")
+    layout, field, symmetry = banner[2:]
+    if layout not in ("coordinate", "array"):
+        raise ValueError("Unknown Matrix Market format: {}".format(layout))
+    if field not in ("real", "double", "integer", "pattern"):
+        raise ValueError("Unsupported Matrix Market field: {}".format(field))
+    if symmetry not in ("general", "symmetric", "skew-symmetric", "hermitian"):
+        raise ValueError("Unknown Matrix Market symmetry: {}".format(symmetry))
+    line = stream.readline()
+    while line.startswith(b"%") or not line.strip():
+        if not line:
+            raise ValueError("The Matrix Market file has no size line")
+        line = stream.readline()
+    sizes = [int(size) for size in line.split()]
+    return layout, field, symmetry, sizes
+
+def _matrix_market_chunks(stream, chunk_bytes, usecols=None, dtype=np.float64):
+    # Yields the entries of a Matrix Market file about `chunk_bytes` of text at a time, as a (lines, columns) array,
+    # cutting every block at its last line break; `usecols` picks the columns to convert, so a pass that only needs
+    # the indices does not parse the values
+    rest = b""
+    while True:
+        block = stream.read(chunk_bytes)
+        text = rest + block
+        cut = len(text) if not block else text.rfind(b"\n") + 1
+        text, rest = text[:cut], text[cut:]
+        if text and not text.isspace():
+            yield np.loadtxt(io.BytesIO(text), dtype=dtype, usecols=usecols, ndmin=2)
+        if not block:
+            return
+
+def read_matrix_market(path, chunk_bytes=2**24):
+    """
+    Reads a Matrix Market file (.mtx, or .mtx.gz), in coordinate format as a CSR matrix and in array format as a
+    dense array, so the result can go straight to `matrix_calculator`. Real, integer and pattern fields are
+    understood, with general, symmetric, skew-symmetric or hermitian (real) symmetry; the entries a symmetric
+    file leaves out are filled in.
+    Entries are parsed about `chunk_bytes` of text at a time. A coordinate file is read twice, first to count the
+    entries of every row and then to drop each chunk straight into its place in the CSR arrays, so the memory
+    needed is the final matrix plus one chunk.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as stream:
+        layout, field, symmetry, sizes = _matrix_market_header(stream)
+        mirror = symmetry != "general"
+        sign = -1.0 if symmetry == "skew-symmetric" else 1.0
+        if layout == "array":
+            rows, cols = sizes[:2]
+            if mirror: # only the lower triangle is stored, column by column
+                upper_i, upper_j = np.triu_indices(cols, 1 if symmetry == "skew-symmetric" else 0)
+                entry_i, entry_j = upper_j, upper_i
+            values = np.concatenate([chunk.ravel() for chunk in _matrix_market_chunks(stream, chunk_bytes)] or
+                                    [np.empty(0)])
+            if not mirror:
+                if values.size != rows*cols:
+                    raise ValueError("Expected {} entries, found {}".format(rows*cols, values.size))
+                return values.reshape(rows, cols, order="F")
+            if values.size != entry_i.size:
+                raise ValueError("Expected {} entries, found {}".format(entry_i.size, values.size))
+            A = np.zeros((rows, cols))
+            A[entry_i, entry_j] = values
+            A[entry_j, entry_i] = sign*values
+            if symmetry == "skew-symmetric":
+                A[entry_i, entry_j] = values # the mirror above must not overwrite the stored entries
+            return A
+        rows, cols, nnz = sizes[:3]
+        index_type = np.int32 if max(rows, cols, 2*nnz) < 2**31 else np.int64
+        # first pass: how many entries every row will hold, counting the mirrored ones
+        counts = np.zeros(rows, dtype=np.int64)
+        found = 0
+        for chunk in _matrix_market_chunks(stream, chunk_bytes, (0, 1), np.int64):
+            i, j = chunk[:, 0] - 1, chunk[:, 1] - 1
+            counts += np.bincount(i, minlength=rows)
+            if mirror:
+                counts += np.bincount(j[i != j], minlength=rows)
+            found += len(chunk)
+        if found != nnz:
+            raise ValueError("Expected {} entries, found {}".format(nnz, found))
+    indptr = np.zeros(rows + 1, dtype=index_type)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=index_type)
+    data = np.empty(indptr[-1])
+    fill = indptr[:-1].astype(np.int64) # the next free slot of every row
+    # second pass: every entry goes straight to its slot
+    with opener(path, "rb") as stream:
+        _matrix_market_header(stream)
+        for chunk in _matrix_market_chunks(stream, chunk_bytes):
+            i, j = chunk[:, 0].astype(np.int64) - 1, chunk[:, 1].astype(np.int64) - 1
+            v = np.ones(len(chunk)) if field == "pattern" else chunk[:, 2]
+            if mirror:
+                off = i != j
+                i, j, v = np.concatenate([i, j[off]]), np.concatenate([j, i[off]]), np.concatenate([v, sign*v[off]])
+            order = np.argsort(i, kind="stable")
+            i, j, v = i[order], j[order], v[order]
+            # the rank of every entry among the entries of the same row in this chunk
+            first = np.searchsorted(i, i)
+            slots = fill[i] + np.arange(len(i)) - first
+            indices[slots] = j
+            data[slots] = v
+            fill += np.bincount(i, minlength=rows)
+    A = sp.csr_matrix((data, indices, indptr), shape=(rows, cols))
+    A.sort_indices()
+    return A
+
+def load_array(path, key=None, shape=None):
+    """
+    Loads a matrix or vector from a binary file, so that large systems do not have to be written out as text:
+    .npy files are memory-mapped, so only the pages a solver touches are read from disk;
+    .mtx (and .mtx.gz) Matrix Market files are read with `read_matrix_market`;
+    .npz archives give the array named `key` (or their only array), and archives written by
+    scipy.sparse.save_npz give a sparse matrix;
+    any other file is read as raw little-endian float64 values, memory-mapped, and reshaped to `shape` if given.
+    Nothing is copied here: a float64 array is used by the solvers as it is, and any other dtype is only converted
+    where a solver needs it.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".mtx" or path.lower().endswith(".mtx.gz"):
+        values = read_matrix_market(path)
+    elif extension == ".npy":
+        values = np.load(path, mmap_mode="r")
+    elif extension == ".npz":
+        with np.load(path) as archive:
+            if "format" in archive.files and "indptr" in archive.files:
+                return sp.load_npz(path).tocsr()
+            if key is None:
+                if len(archive.files) != 1:
+                    raise ValueError("{} holds {} arrays; name the one to use".format(path, len(archive.files)))
+                key = archive.files[0]
+            values = archive[key]
+    else:
+        values = np.memmap(path, dtype="<f8", mode="r")
+    if shape is not None:
+        values = values.reshape(shape)
+    return values
+
+def write_array(path, x, fmt=None):
+    """
+    Writes the answer x to a binary file: "npy" for a .npy file, "raw" for bare little-endian float64 values, or
+    "memmap" for a .npy file that is created memory-mapped and filled in place, so a reader can map it as well.
+    Without `fmt` the format follows the extension, .npy or raw for anything else.
+    """
+    if fmt is None:
+        fmt = "npy" if path.lower().endswith(".npy") else "raw"
+    x = np.asarray(x)
+    if fmt == "npy":
+        np.save(path, x)
+    elif fmt == "raw":
+        x.astype("<f8", copy=False).tofile(path)
+    elif fmt == "memmap":
+        mapped = np.lib.format.open_memmap(path, mode="w+", dtype="<f8", shape=x.shape)
+        mapped[...] = x
+        mapped.flush()
+        del mapped
+    else:
+        raise ValueError("Unknown output format: {}".format(fmt))
+
+def _load_system_file(path, kind, rows=None):
+    # Loads A (kind "A") or B (kind "B") for the command line. A raw A is taken to be square, and a raw B is split
+    # into as many rows as A has.
+    values = load_array(path)
+    if kind != "A" and sp.issparse(values): # a vector in Matrix Market coordinate format
+        values = values.toarray()
+    if values.ndim == 1 and kind == "A":
+        n = int(round(math.sqrt(values.size)))
+        if n*n != values.size:
+            raise ValueError("{} holds {} values, which is not a square matrix".format(path, values.size))
+        values = values.reshape(n, n)
+    elif values.ndim == 1 and rows and values.size != rows and values.size % rows == 0:
+        values = values.reshape(rows, -1) # one column per right-hand side
+    if kind == "A" and values.ndim != 2:
+        raise ValueError("{} holds a {}-dimensional array, not a matrix".format(path, values.ndim))
+    return values
+
+BatchSystem = namedtuple("BatchSystem", ["id", "A", "B", "x0", "error"])
+
+def _system_value(value):
+    # A matrix given in an NDJSON line: text in the command line format, or nested lists
+    if isinstance(value, str):
+        return parse_matrix(value)
+    return np.array(value, dtype=float)
+
+def _error_text(e):
+    # The message of an exception for the "error" of a result record; the type is kept for anything that is not a
+    # plain ValueError or IOError, whose messages do not make sense on their own
+    if isinstance(e, (ValueError, IOError)):
+        return str(e)
+    return "{}: {}".format(type(e).__name__, e)
+
+def _ndjson_systems(stream):
+    # The systems of an NDJSON stream, one JSON object per line. "A" and "B" (and optionally "x0") are nested lists
+    # or matrix text, or "A_file", "B_file" and "x0_file" name files for `load_array`; "id" defaults to the line number
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        name = number
+        arrays = {}
+        try:
+            entry = json.loads(line)
+            if not isinstance(entry, dict):
+                raise ValueError("line {} is not a JSON object".format(number))
+            name = entry.get("id", number)
+            for kind in ("A", "B", "x0"):
+                if kind + "_file" in entry:
+                    rows = np.shape(arrays["A"])[0] if kind != "A" else None
+                    arrays[kind] = _load_system_file(entry[kind + "_file"], "A" if kind == "A" else "B", rows)
+                elif kind in entry:
+                    arrays[kind] = _system_value(entry[kind])
+                elif kind != "x0":
+                    raise ValueError("line {} has no {}".format(number, kind))
+        except Exception as e: # whatever is wrong with one line only ends up in the record of that line
+            yield BatchSystem(name, None, None, None, _error_text(e))
+        else:
+            yield BatchSystem(name, arrays["A"], arrays["B"], arrays.get("x0"), None)
+
+def _archive_systems(path, name=None):
+    # The systems of one .npz archive: "A" and "B" (and "x0") for one system or, with a leading batch axis on A, a
+    # stack of them; otherwise pairs of arrays named "A_<id>" and "B_<id>" (and "x0_<id>"). `name` is the id of the
+    # archive itself, and prefixes the ids of the systems in it
+    def system_id(key):
+        return key if name is None else "{}/{}".format(name, key)
+    def system(key, read):
+        # reads one system, turning whatever goes wrong into the error of that system
+        try:
+            return BatchSystem(key, *read(), error=None)
+        except Exception as e:
+            return BatchSystem(key, None, None, None, _error_text(e))
+    with np.load(path) as archive:
+        files = archive.files
+        if "A" in files and "B" in files:
+            A, B = archive["A"], archive["B"]
+            x0 = archive["x0"] if "x0" in files else None
+            if A.ndim != 3:
+                yield BatchSystem(0 if name is None else name, A, B, x0, None)
+                return
+            for index in range(A.shape[0]):
+                yield system(system_id(index), lambda: (A[index], B[index], None if x0 is None else x0[index]))
+            return
+        for key in files:
+            if not key.startswith("A_"):
+                continue
+            key = key[2:]
+            if "B_" + key not in files:
+                yield BatchSystem(system_id(key), None, None, None, "{} has no B_{}".format(path, key))
+                continue
+            yield system(system_id(key), lambda: (archive["A_" + key], archive["B_" + key],
+                                                  archive["x0_" + key] if "x0_" + key in files else None))
+
+def read_systems(source):
+    """
+    Reads a stream of systems for `solve_systems`, one at a time, as BatchSystem tuples (id, A, B, x0, error).
+    `source` is "-" for NDJSON on standard input, a directory of .npz archives (read in name order), a .npz
+    archive holding several systems, or a file of NDJSON lines. In NDJSON every line is an object with "A" and "B"
+    (and optionally "x0" and an "id"), either as nested lists or as matrix text like '1,2;3,4', or with "A_file"
+    and "B_file" naming files that `load_array` can read. An archive holds either "A" and "B", where A may be a
+    stack of matrices, or pairs named "A_<id>" and "B_<id>".
+    A system that cannot be read is yielded with its `error` set instead of stopping the stream.
+    """
+    if source == "-":
+        for system in _ndjson_systems(sys.stdin):
+            yield system
+    elif os.path.isdir(source):
+        for file_name in sorted(os.listdir(source)):
+            if file_name.lower().endswith(".npz"):
+                for system in _guarded_archive_systems(os.path.join(source, file_name),
+                                                       os.path.splitext(file_name)[0]):
+                    yield system
+    elif source.lower().endswith(".npz"):
+        for system in _guarded_archive_systems(source):
+            yield system
+    else:
+        with open(source) as stream:
+            for system in _ndjson_systems(stream):
+                yield system
+
+def _guarded_archive_systems(path, name=None):
+    # `_archive_systems`, except that an archive that cannot be opened at all, or breaks off, becomes one more system
+    # with the error
+    try:
+        for system in _archive_systems(path, name):
+            yield system
+    except Exception as e:
+        yield BatchSystem(path if name is None else name, None, None, None, _error_text(e))
 
 #from Stackoverflow.com suggests this for storing command line inputs as an array:
 class StoreAsArray(argparse._StoreAction):
+    # Parses a matrix argument with `parse_matrix`; "-" reads the matrix from standard input instead
     # noinspection PyCompatibility
     def __call__(self, parser, namespace, values, option_string=None):
-        values = values.split(';')
-        rows = len(values)
-        m = values[0].split(',')
-        i = 1
-        while i < rows:
-            n = values[i].split(',')
-            m = np.vstack((m,n))
-            i += 1
-        rows, cols = m.shape
-        #now " m" is the matrix that has everything in terms of a string
-        # to convert everything to a string:
-        new_a = np.zeros((rows, cols))
-        new_b = np.zeros(rows)
-        for j in range(rows):
-            if cols != 0:
-                for k in range(cols):
-                    new_a[j,k] = float((m[j,k]))
-            else:
-                new_b[j] = float(m[j])
-        if cols != 0:
-            values = new_a
-        else:
-            values = new_b
-
+        if values == "-":
+            values = sys.stdin.read()
+        if values is not None: # argparse passes the default along for a positional argument that was left out
+            values = parse_matrix(values)
         return super().__call__(parser, namespace, values, option_string)
 
 def warning(*objs):
     """Writes a message to stderr."""
     print("WARNING: ", *objs, file=sys.stderr)
 
-def residual(A, B, guess, row, col): #function that calculates the residual error each time a new iteration occurs
-    build = 0
-    for i in range(row):
-        temp = B[i]
-        for j in range(col):
-            temp = temp - A[i,j]*guess[j]
-        build += temp**2
-    r = math.sqrt(build)
-    return r
+def _submatrix(A, row, col):
+    # Restricts A to its leading row x col block; slicing a sparse matrix copies it, so only do it when needed
+    if A.shape == (row, col):
+        return A
+    return A[:row, :col]
+
+def _diagonal(A, row, perm=None):
+    # Works for dense arrays and for scipy.sparse matrices alike. With a row permutation `perm`, returns the
+    # diagonal of A[perm] without forming it: entry i is A[perm[i], i].
+    if perm is None:
+        return np.asarray(A.diagonal()[:row], dtype=float)
+    return np.asarray(A[perm, np.arange(row)], dtype=float).ravel()
+
+def _matvec(A, x, out):
+    # Writes A*x into "out"; BLAS writes straight into the buffer when the dtypes already agree
+    if sp.issparse(A):
+        out[...] = A.dot(x) # O(nnz) for both CSR and CSC
+        return out
+    try:
+        np.dot(A, x, out=out)
+    except ValueError:
+        out[...] = np.dot(A, x)
+    return out
+
+def _norm(r, norm, B):
+    # Reduces a residual vector to a single number, or a block of residual columns to one number per column,
+    # without allocating a temporary of the residual's size
+    if r.ndim == 2:
+        if norm == "inf":
+            return np.maximum(r.max(axis=0), -r.min(axis=0))
+        l2 = np.sqrt(np.einsum("ij,ij->j", r, r))
+        if norm == "rel":
+            b = np.reshape(B, r.shape)
+            b_norm = np.sqrt(np.einsum("ij,ij->j", b, b))
+            return l2/np.where(b_norm != 0, b_norm, 1.0)
+        elif norm != "l2":
+            raise ValueError("Unknown residual norm: {}".format(norm))
+        return l2
+    if norm == "inf":
+        return max(r.max(), -r.min())
+    l2 = math.sqrt(np.dot(r, r))
+    if norm == "rel":
+        b = np.ravel(B)
+        b_norm = math.sqrt(np.dot(b, b))
+        if b_norm != 0:
+            return l2/b_norm
+    elif norm != "l2":
+        raise ValueError("Unknown residual norm: {}".format(norm))
+    return l2
+
+def residual(A, B, guess, row, col, norm="l2", work=None): #function that calculates the residual error each time a new iteration occurs
+    """
+    Returns the norm of the residual B - A*guess, computed with a single matrix-vector product.
+    `norm` is "l2" (the default), "inf" for the largest entry, or "rel" for the L2 norm divided by the L2 norm of B.
+    If `guess` is an n x k block (one column per right-hand side in B), an array with the norm of every column
+    is returned instead.
+    `work` is an optional preallocated array shaped like `guess` that receives the residual vector, so that
+    the solver loops can call this function every iteration without allocating anything.
+    """
+    if work is None:
+        work = np.empty((row,) + np.shape(guess)[1:])
+    _matvec(_submatrix(A, row, col), guess[:col], work)
+    np.subtract(np.reshape(np.asarray(B)[:row], work.shape), work, out=work)
+    return _norm(work, norm, np.asarray(B)[:row])
+
+def _rhs_block(B, row):
+    # Returns B as an n x k block and whether the caller passed a single right-hand side (a vector or an n x 1 column)
+    b = np.asarray(B, dtype=float)[:row]
+    single = b.ndim == 1 or b.shape[1] == 1
+    return b.reshape(row, -1), single
 
+def _checked_guess(x0, n):
+    # x0 as a float array, after making sure it has one row per unknown
+    x0 = np.asarray(x0, dtype=float)
+    if np.ndim(x0) == 0 or x0.shape[0] != n:
+        raise ValueError("x0 has {} rows but there are {} unknowns".format(x0.shape[0] if x0.ndim else 0, n))
+    return x0
+
+def _initial_guess(x0, b):
+    # The starting iterate as a block shaped like b: zeros, or x0, where a single vector starts every column of B
+    x = np.zeros(b.shape)
+    if x0 is not None:
+        x[...] = _checked_guess(x0, len(x)).reshape(len(x), -1)
+    return x
+
+class _Monitor(object):
+    # Decides when an iteration loop has to give up before converging: after `max_iter` iterations, after
+    # `time_limit` seconds, when the residual has grown `growth` times past its first value or stopped being a
+    # finite number (diverged), or when it has not improved by at least 0.1% in `window` iterations (stagnated).
+    def __init__(self, max_iter=10000, time_limit=None, growth=1e8, window=200):
+        self.max_iter = max_iter
+        self.time_limit = time_limit
+        self.deadline = None if time_limit is None else time.time() + time_limit
+        self.growth = growth
+        self.window = window
+        self.iterations = 0
+        self.reason = None
+        self.first = None
+        self.best = np.inf
+        self.best_iteration = 0
+        self.history = [] # the residual (the worst one for a block) of every iterate checked
+
+    def column(self):
+        # A fresh monitor for the next column of a block that is solved one column at a time; the deadline is shared
+        monitor = _Monitor(self.max_iter, None, self.growth, self.window)
+        monitor.deadline = self.deadline
+        return monitor
+
+    def absorb(self, monitor):
+        # Folds the record of one column's monitor into this one; the column histories follow each other
+        self.iterations = max(self.iterations, monitor.iterations)
+        self.history.extend(monitor.history)
+        self.reason = self.reason or monitor.reason
+
+    def stop(self, res, steps=1):
+        # Records the residual of the iterate about to be improved (the worst one for a block) and returns True if
+        # the loop must stop instead; otherwise the `steps` iterations that follow are counted
+        if np.size(res) == 0:
+            return False
+        res = float(np.max(res))
+        self.history.append(res)
+        if self.first is None:
+            self.first = res
+        if not math.isfinite(res) or res > self.growth*self.first:
+            self.reason = "diverged"
+        elif self.iterations >= self.max_iter:
+            self.reason = "max_iter"
+        elif self.deadline is not None and time.time() > self.deadline:
+            self.reason = "time_limit"
+        elif res < 0.999*self.best:
+            self.best, self.best_iteration = res, self.iterations
+        elif self.iterations - self.best_iteration >= self.window:
+            self.reason = "stagnated"
+        if self.reason is not None:
+            return True
+        self.iterations += steps
+        return False
+
+def _tolerance(b, atol, rtol):
+    # The convergence threshold of every column of b: the residual error must be less than this to be converged
+    return np.maximum(atol, rtol*np.sqrt(np.einsum("ij,ij->j", b, b)))
+
+def _retire_converged(res, x, cols, answer, final_res, monitor, tol, steps=1):
+    # Copies the columns of the block iterate that have converged into the answer and returns a mask of those that
+    # are still running, so the next sweep only multiplies the unconverged columns. When the monitor stops the
+    # solve, every running column is retired with its last iterate.
+    done = res <= tol[cols]
+    if done.all():
+        monitor.history.append(float(np.max(res))) # the converged iterate is not checked by the monitor
+    elif monitor.stop(res[~done], steps):
+        done[:] = True
+    answer[:, cols[done]] = x[:, done]
+    final_res[cols[done]] = res[done]
+    return ~done
+
+def _result(function, answer, final_res, single, monitor, full_output):
+    # Shapes the answer like B was shaped and, if asked for, adds a record of how the solve went
+    if single:
+        answer, final_res = answer[:, 0], final_res[0]
+    if monitor.reason is not None:
+        function = function.replace("the answer is:",
+                                    "stopped early ({}), the last iterate is:".format(monitor.reason))
+    if not full_output:
+        return function, answer
+    info = {"converged": monitor.reason is None, "reason": monitor.reason or "converged",
+            "iterations": monitor.iterations, "residual": final_res, "history": monitor.history}
+    return function, answer, info
+
+
+def _gauss_siedel_sweep(A, b, x, w, diag, eq):
+    # One in-place Gauss-Siedel/SOR sweep. Each row only touches its stored entries, so a sparse sweep is O(nnz).
+    # With a block of right-hand sides every row update is done for all of the columns at once.
+    # Unknown i is updated from equation eq[i], the row of A (and of b) that carries its diagonal entry.
+    # Returns the L2 norm of the change made to every column, which costs nothing extra to collect.
+    change = np.zeros(x.shape[1])
+    if x.shape[1] == 1:
+        x, b, change = x[:, 0], b[:, 0], 0.0 # views, so the updates still land in the caller's block
+    if sp.issparse(A):
+        indptr, indices, data = A.indptr, A.indices, A.data
+        for i in range(len(x)):
+            p = eq[i]
+            start, end = indptr[p], indptr[p+1]
+            term = np.dot(data[start:end], x[indices[start:end]]) - diag[i]*x[i]
+            new = (x[i] - w*x[i]) + (w/diag[i])*(b[p] - term)
+            change += (new - x[i])**2
+            x[i] = new
+    else:
+        for i in range(len(x)):
+            p = eq[i]
+            term = np.dot(A[p], x) - diag[i]*x[i]
+            new = (x[i] - w*x[i]) + (w/diag[i])*(b[p] - term)
+            change += (new - x[i])**2
+            x[i] = new
+    return np.sqrt(np.atleast_1d(change))
+
+def _gauss_siedel_residual_sweep(At, r, x, w, diag, eq):
+    # One in-place Gauss-Siedel/SOR sweep that also keeps the residual r = B - A*x up to date. Changing x[i] by
+    # delta only changes r by delta times column i of A, so `At` holds A by columns (CSC, or a column-major array)
+    # and each update costs O(nnz of column i). The norm of r is then available at the end of the sweep for free.
+    # As in `_gauss_siedel_sweep`, unknown i is updated from the residual of equation eq[i].
+    change = np.zeros(x.shape[1])
+    if x.shape[1] == 1:
+        x, r, change = x[:, 0], r[:, 0], 0.0 # views, so the updates still land in the caller's block
+    scale = np.multiply if x.ndim == 1 else np.multiply.outer # a column of A times one delta, or one per column of B
+    if sp.issparse(At):
+        indptr, indices, data = At.indptr, At.indices, At.data
+        for i in range(len(x)):
+            delta = (w/diag[i])*r[eq[i]]
+            x[i] += delta
+            start, end = indptr[i], indptr[i+1]
+            r[indices[start:end]] -= scale(data[start:end], delta)
+            change += delta**2
+    else:
+        for i in range(len(x)):
+            delta = (w/diag[i])*r[eq[i]]
+            x[i] += delta
+            r -= scale(At[:, i], delta)
+            change += delta**2
+    return np.sqrt(np.atleast_1d(change))
 
-def gauss_siedel(A, B, row, col, w):
-    if w != 1.0:
+def color_classes(A):
+    """
+    Splits the unknowns of A into color classes, such that no two unknowns in the same class are coupled by A.
+    Matrices with a bipartite graph, such as 5-point and 7-point stencils, get the two red-black classes from a
+    single breadth-first search; other matrices are colored greedily.
+    Returns a list with the index array of every color.
+    """
+    G = abs(sp.csr_matrix(A))
+    G = (G + G.T).tocsr()
+    G.setdiag(0)
+    G.eliminate_zeros()
+    n = G.shape[0]
+    # Red-black: color by the parity of the distance from a root in each connected component. A virtual
+    # source joined to one root per component lets a single search reach all of them.
+    ncomp, labels = csgraph.connected_components(G, directed=False)
+    roots = np.unique(labels, return_index=True)[1]
+    source = sp.csr_matrix((np.ones(ncomp), (np.zeros(ncomp, dtype=int), roots)), shape=(1, n))
+    S = sp.bmat([[G, None], [source, sp.csr_matrix((1, 1))]], format="csr")
+    color = csgraph.shortest_path(S, directed=False, unweighted=True, indices=n)[:n].astype(int) % 2
+    rows, cols = G.nonzero()
+    if np.any(color[rows] == color[cols]): # not bipartite, so fall back to greedy coloring
+        color = np.full(n, -1)
+        indptr, indices = G.indptr, G.indices
+        for i in range(n):
+            taken = set(color[indices[indptr[i]:indptr[i+1]]].tolist())
+            c = 0
+            while c in taken:
+                c += 1
+            color[i] = c
+    return [np.flatnonzero(color == c) for c in range(color.max() + 1)]
+
+def _multicolor_residual_sweep(blocks, r, x, w):
+    # The multicolor sweep that keeps the residual r = B - A*x up to date: the unknowns of one color are updated
+    # from their own residual entries, and r is then corrected with one product over the columns of that color.
+    change = np.zeros(x.shape[1])
+    for idx, eq, columns, diag in blocks:
+        delta = (w/diag)*r[eq]
+        x[idx] += delta
+        r -= columns.dot(delta)
+        change += np.einsum("ij,ij->j", delta, delta)
+    return np.sqrt(change)
+
+def _multicolor_sweep(blocks, b, x, w):
+    # One in-place Gauss-Siedel/SOR sweep in multicolor order. The unknowns of one color do not depend on each
+    # other, so each color is updated with a single matrix product over its own rows.
+    # Returns the L2 norm of the change made to every column.
+    change = np.zeros(x.shape[1])
+    for idx, eq, rows, diag in blocks:
+        x_c = x[idx]
+        term = rows.dot(x) - diag*x_c
+        new = (x_c - w*x_c) + (w/diag)*(b[eq] - term)
+        x_c -= new
+        change += np.einsum("ij,ij->j", x_c, x_c)
+        x[idx] = new
+    return np.sqrt(change)
+
+def jacobi_spectral_radius(A, iterations=20, perm=None):
+    """
+    Estimates the spectral radius of the Jacobi iteration matrix D^-1 (L + U) = I - D^-1 A with a few power
+    iterations, each of which costs one matrix-vector product. Two steps are taken per estimate, so that the
+    eigenvalue pairs +rho and -rho of the matrices this is meant for do not make the estimate oscillate.
+    With a row permutation `perm` (see `dominant_permutation`) the estimate is for A[perm].
+    """
+    n = A.shape[0]
+    inv_diag = 1.0/_diagonal(A, n, perm)
+    v = np.random.RandomState(0).uniform(0.5, 1.5, n) # a fixed start, so the same matrix always gets the same w
+    v /= math.sqrt(np.dot(v, v))
+    w = np.empty(n)
+    rho = 0.0
+    for i in range(iterations):
+        for step in range(2):
+            _matvec(A, v, w)
+            if perm is not None:
+                w = w[perm]
+            w *= inv_diag
+            np.subtract(v, w, out=w)
+            v, w = w, v
+        size = math.sqrt(np.dot(v, v))
+        if size == 0 or not np.isfinite(size):
+            break
+        rho = math.sqrt(size)
+        v /= size
+    return rho
+
+def optimal_omega(A, perm=None):
+    """
+    Returns the relaxation factor w = 2/(1 + sqrt(1 - rho^2)) that is optimal for SOR on consistently ordered
+    matrices, where rho is the estimated spectral radius of the Jacobi iteration matrix. If the Jacobi iteration
+    does not converge (rho >= 1) the formula does not apply, and plain Gauss (w = 1) is used instead.
+    With a row permutation `perm` the factor is for A[perm].
+    """
+    rho = jacobi_spectral_radius(A, perm=perm)
+    if rho >= 1:
+        return 1.0
+    return 2.0/(1.0 + math.sqrt(1.0 - rho**2))
+
+def _gauss_siedel_steps(A, b, row, col, w, ordering, check_every, criterion, incremental, perm, x0):
+    # The Gauss-Siedel/SOR iteration as a generator over n x k blocks, for `gauss_siedel` and
+    # `gauss_siedel_iterates`. Yields (iteration, x, res) every `check_every` sweeps, with x the iterate itself.
+    # Sending a mask of the columns to keep back in drops the others from the sweeps that follow.
+    if criterion not in ("residual", "update"):
+        raise ValueError("Unknown convergence criterion: {}".format(criterion))
+    if check_every < 1: # no sweeps between checks would never move the iteration on
+        raise ValueError("check_every must be at least 1, not {}".format(check_every))
+    A = _submatrix(A, row, col)
+    if sp.issparse(A):
+        # the sweep needs fast access to each row, or to each column when the residual is kept up to date;
+        # the conversion is free when A is already in that format
+        A = A.tocsc() if incremental else A.tocsr()
+    elif incremental:
+        A = np.asfortranarray(A)
+    diag = _diagonal(A, row, perm)
+    eq = np.arange(row) if perm is None else perm # the equation each unknown is updated from
+    if ordering == "multicolor":
+        # the rows (or columns) of each color are gathered once, so the sweeps do not have to slice A
+        classes = color_classes(A if perm is None else A[perm])
+        blocks = [(idx, eq[idx], A[:, idx] if incremental else A[eq[idx]], diag[idx, np.newaxis]) for idx in classes]
+    elif ordering != "natural":
+        raise ValueError("Unknown ordering: {}".format(ordering))
+    x = _initial_guess(x0, b)
+    work = np.empty(b.shape) # the residual vectors, allocated once per set of running columns
+    res = residual(A, b, x, row, col, work=work)
+    iteration = 0
+    while True:
+        keep = yield iteration, x, res
+        if keep is not None and not keep.all():
+            b, x = b[:, keep], x[:, keep]
+            work = work[:, keep] if incremental else np.empty(b.shape)
+        for sweep in range(check_every):
+            if incremental and ordering == "multicolor":
+                change = _multicolor_residual_sweep(blocks, work, x, w)
+            elif incremental:
+                change = _gauss_siedel_residual_sweep(A, work, x, w, diag, eq)
+            elif ordering == "multicolor":
+                change = _multicolor_sweep(blocks, b, x, w)
+            else:
+                change = _gauss_siedel_sweep(A, b, x, w, diag, eq)
+        iteration += check_every
+        if criterion == "update":
+            res = change
+        elif incremental:
+            res = _norm(work, "l2", b)
+        else:
+            res = residual(A, b, x, row, col, work=work)
+
+def gauss_siedel_iterates(A, B, row, col, w, ordering="natural", check_every=1, criterion="residual",
+                          incremental=False, perm=None, x0=None):
+    """
+    Runs the Gauss-Siedel/SOR iteration of `gauss_siedel` lazily. Yields (iteration, x, residual) for the starting
+    guess and then after every `check_every` sweeps, where residual is the norm of B - A*x (or, with `criterion`
+    set to "update", of the change the last sweeps made), one per column when B is a block.
+    x is the solver's own iterate, not a copy: it changes with the next sweep, so copy it to keep it.
+    The generator never stops by itself; the caller decides when the iterate is good enough.
+    The other arguments are those of `gauss_siedel`.
+    """
+    if w == "auto":
+        w = optimal_omega(_submatrix(A, row, col), perm)
+    b, single = _rhs_block(B, row)
+    for iteration, x, res in _gauss_siedel_steps(A, b, row, col, w, ordering, check_every, criterion, incremental,
+                                                 perm, x0):
+        yield (iteration, x[:, 0], res[0]) if single else (iteration, x, res)
+
+def gauss_siedel(A, B, row, col, w, ordering="natural", max_iter=10000, time_limit=None, full_output=False,
+                 atol=0.01, rtol=0.0, check_every=1, criterion="residual", incremental=False, perm=None, x0=None):
+    """
+    Solves A*x = B with the Gauss (w = 1) or Gauss-Siedel/SOR (w != 1) method.
+    If w is "auto" the relaxation factor is picked by `optimal_omega`, and the value used is part of the message.
+    A may be a dense array or a CSR/CSC sparse matrix; sparse matrices are swept row by row over their nonzeros.
+    With `ordering` set to "multicolor" the unknowns are swept color by color (see `color_classes`) instead of in
+    their natural order, so every sweep is a few vectorized updates instead of one Python step per row.
+    The columns of a block B are swept together.
+    Computing the residual costs as much as a sweep, so it is only checked every `check_every` sweeps. With
+    `criterion` set to "update" the norm of the change made by the last sweep is compared with the tolerance
+    instead, which needs no extra matrix product at all.
+    With `incremental` the residual vector is kept up to date during the sweep, one column of A per updated unknown,
+    so its norm is known at the end of every sweep without a separate matrix product. The sweep then reads A by
+    columns rather than by rows.
+    `perm` is an optional row permutation (see `dominant_permutation`): the iteration is then run on the system
+    A[perm]*x = B[perm], reading the rows of A through the index array instead of reordering A.
+    Tolerances, `x0`, the stopping rules and `full_output` are as described in `matrix_calculator`; the
+    `full_output` dict also has the relaxation factor "omega" that was used.
+    The iteration itself is `gauss_siedel_iterates`; this function only decides when to stop it.
+    """
+    if w == "auto":
+        w = optimal_omega(_submatrix(A, row, col), perm)
+        function = "Using the Gauss-Siedel method with w = {:.4f}, the answer is:".format(w)
+    elif w != 1.0:
         function = "Using the Gauss-Siedel method, the answer is:"
     else:
         function = "Using the Gauss method, the answer is:"
-    initial_guess = np.zeros(row)
-    res = residual(A, B, initial_guess, row, col)
-    x = initial_guess
-    while res > 0.01: # the residual error must be less than this for the system to stop guessing and be considered converged
-        for i in range(row):
-            term = 0
-            for j in range(col):
-                if i != j:
-                    term = term + A[i,j]*x[j]
-            x[i] = (x[i] - w*x[i]) + (w/A[i,i])*(B[i] - term)
-        res = residual(A, B, x, row, col)
-    return function, x
-
-def jacobi(A, B, row, col):
+    b, single = _rhs_block(B, row)
+    monitor = _Monitor(max_iter, time_limit)
+    tol = _tolerance(b, atol, rtol)
+    answer = np.zeros(b.shape)
+    final_res = np.zeros(b.shape[1])
+    cols = np.arange(b.shape[1]) # the columns of B that have not converged yet
+    steps = _gauss_siedel_steps(A, b, row, col, w, ordering, check_every, criterion, incremental, perm, x0)
+    iteration, x, res = next(steps)
+    while True:
+        keep = _retire_converged(res, x, cols, answer, final_res, monitor, tol, check_every)
+        cols = cols[keep]
+        if cols.size == 0:
+            break
+        iteration, x, res = steps.send(keep)
+    if criterion == "update" and full_output:
+        final_res = residual(A, b, answer, row, col) # report the true residual, once
+    result = _result(function, answer, final_res, single, monitor, full_output)
+    if full_output:
+        result[2]["omega"] = w
+    return result
+
+def _jacobi_steps(A, b, row, col, criterion, perm, x0):
+    # The Jacobi iteration as a generator over n x k blocks, for `jacobi` and `jacobi_iterates`. Yields
+    # (iteration, x, res) before every sweep, with x the iterate itself; sending a mask of the columns to keep
+    # back in drops the others from the sweeps that follow.
+    if criterion not in ("residual", "update"):
+        raise ValueError("Unknown convergence criterion: {}".format(criterion))
+    A = _submatrix(A, row, col)
+    inv_diag = 1.0/_diagonal(A, row, perm)[:, np.newaxis] # computed once, since it does not change between sweeps
+    x = _initial_guess(x0, b) # old iterate
+    x_new = np.empty(b.shape) # new iterate; the two buffers are swapped after every sweep
+    work = np.empty(b.shape) # the residual of the old iterate
+    iteration = 0
+    while True:
+        _matvec(A, x, work) # A*x
+        np.subtract(b, work, out=work)
+        if perm is not None:
+            np.take(work, perm, axis=0, out=x_new) # the residual of the permuted system, in its row order
+            x_new *= inv_diag
+        else:
+            np.multiply(work, inv_diag, out=x_new) # D^-1 (B - A x), the change this sweep makes
+        keep = yield iteration, x, _norm(x_new if criterion == "update" else work, "l2", b)
+        if keep is not None and not keep.all():
+            # Buffers are only reallocated when a column converges, so there are at most k reallocations per solve
+            b, x, x_new = b[:, keep], x[:, keep], x_new[:, keep]
+            work = np.empty(b.shape)
+        x_new += x
+        x, x_new = x_new, x
+        iteration += 1
+
+def jacobi_iterates(A, B, row, col, criterion="residual", perm=None, x0=None):
+    """
+    Runs the Jacobi iteration of `jacobi` lazily. Yields (iteration, x, residual) before every sweep, where
+    residual is the norm of B - A*x (or, with `criterion` set to "update", of the change the sweep is about to
+    make), one per column when B is a block.
+    x is the solver's own iterate, not a copy: it changes with the next sweep, so copy it to keep it.
+    The generator never stops by itself; the caller decides when the iterate is good enough.
+    The other arguments are those of `jacobi`.
+    """
+    b, single = _rhs_block(B, row)
+    for iteration, x, res in _jacobi_steps(A, b, row, col, criterion, perm, x0):
+        yield (iteration, x[:, 0], res[0]) if single else (iteration, x, res)
+
+def jacobi(A, B, row, col, max_iter=10000, time_limit=None, full_output=False, atol=0.01, rtol=0.0,
+           criterion="residual", perm=None, x0=None):
+    """
+    Solves A*x = B with the Jacobi method.
+    Every unknown in a sweep is updated from the previous iterate, x_new = x_old + D^-1 (B - A x_old), so the
+    whole sweep is one matrix product followed by elementwise operations on two alternating buffers. The sweep
+    computes the residual of the old iterate on the way, so checking convergence needs no extra matrix product.
+    The columns of a block B are swept together as one matrix-matrix product.
+    With `criterion` set to "update" the norm of the change the sweep would make is compared with the tolerance
+    instead of the residual.
+    `perm` is an optional row permutation (see `dominant_permutation`): the iteration is then run on the system
+    A[perm]*x = B[perm], by gathering the residual through the index array instead of reordering A.
+    Tolerances, `x0`, the stopping rules and `full_output` are as described in `matrix_calculator`.
+    The iteration itself is `jacobi_iterates`; this function only decides when to stop it.
+    """
     function = "Using the Jacobi method, the answer is:"
-    initial_guess = np.zeros(row)
-    res = residual(A, B, initial_guess, row, col)
-    x = initial_guess
-    while res > 0.01: # the residual error must be less than this for the system to stop guessing and be considered converged
-        for i in range(row):
-            term = 0
-            for j in range(col):
-                if i != j:
-                    term = term + A[i,j]*x[j]
-            x[i] = (B[i] - term)/A[i,i]
-        res = residual(A, B, x, row, col)
-    return function, x
-
-def matrix_calculator(A, B, row, col, solver_type):
+    b, single = _rhs_block(B, row)
+    monitor = _Monitor(max_iter, time_limit)
+    tol = _tolerance(b, atol, rtol)
+    answer = np.zeros(b.shape)
+    final_res = np.zeros(b.shape[1])
+    cols = np.arange(b.shape[1]) # the columns of B that have not converged yet
+    steps = _jacobi_steps(A, b, row, col, criterion, perm, x0)
+    iteration, x, res = next(steps)
+    while True:
+        keep = _retire_converged(res, x, cols, answer, final_res, monitor, tol)
+        cols = cols[keep]
+        if cols.size == 0:
+            break
+        iteration, x, res = steps.send(keep)
+    if criterion == "update" and full_output:
+        final_res = residual(A, b, answer, row, col) # report the true residual, once
+    return _result(function, answer, final_res, single, monitor, full_output)
+
+class Preconditioner(object):
+    """
+    Base class for the preconditioners that the Krylov solvers accept through their `M` argument.
+    A preconditioner is built once for a matrix and then applied every iteration: `apply(r, out)` writes M^-1 r
+    into `out`, where r is a vector or an n x k block.
+    """
+    def apply(self, r, out):
+        out[...] = r
+        return out
+
+class JacobiPreconditioner(Preconditioner):
+    """The diagonal of A, M = D."""
+    def __init__(self, A):
+        self.inv_diag = 1.0/_diagonal(A, A.shape[0])
+
+    def apply(self, r, out):
+        inv_diag = self.inv_diag if r.ndim == 1 else self.inv_diag[:, np.newaxis]
+        return np.multiply(r, inv_diag, out=out)
+
+def _triangular_solver(T, lower):
+    # Returns a function that solves T*y = r for a triangular T. Sparse factors are handed to SuperLU with the
+    # natural ordering and no pivoting, which produces no fill and gives compiled triangular solves.
+    if sp.issparse(T):
+        factor = spla.splu(sp.csc_matrix(T), permc_spec="NATURAL", diag_pivot_thresh=0,
+                           options=dict(SymmetricMode=True))
+        return factor.solve
+    return lambda r: solve_triangular(T, r, lower=lower, check_finite=False)
+
+class SSORPreconditioner(Preconditioner):
+    """
+    Symmetric successive over-relaxation, M = w/(2 - w) (D/w + L) (D/w)^-1 (D/w + U), for 0 < w < 2.
+    Applying it is one forward and one backward triangular solve.
+    """
+    def __init__(self, A, w=1.0):
+        if not 0 < w < 2:
+            raise ValueError("The SSOR relaxation factor must be between 0 and 2, not {}".format(w))
+        self.w = w
+        self.scaled_diag = _diagonal(A, A.shape[0])/w
+        if sp.issparse(A):
+            D = sp.diags(self.scaled_diag)
+            lower, upper = sp.tril(A, -1) + D, sp.triu(A, 1) + D
+        else:
+            lower = np.tril(A, -1) + np.diag(self.scaled_diag)
+            upper = np.triu(A, 1) + np.diag(self.scaled_diag)
+        self.lower_solve = _triangular_solver(lower, True)
+        self.upper_solve = _triangular_solver(upper, False)
+
+    def apply(self, r, out):
+        y = self.lower_solve(r)
+        y *= self.scaled_diag if r.ndim == 1 else self.scaled_diag[:, np.newaxis]
+        out[...] = self.upper_solve(y)
+        out *= (2 - self.w)/self.w
+        return out
+
+def _ranges(starts, ends):
+    # The indices start[0]..end[0]-1, start[1]..end[1]-1, ... as one flat array, without a Python loop
+    lengths = ends - starts
+    return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+def _ilu0(A):
+    # Incomplete LU factorization with zero fill: the factors keep exactly the sparsity pattern of A.
+    # Returns the factors packed in one CSR matrix, the unit lower part below the diagonal and U on and above it.
+    # Row i can be eliminated once every row k it has a lower entry a_ik in is done, so the rows are processed in
+    # levels (wavefronts, the anti-diagonals of a stencil) of rows that do not depend on each other, and every
+    # row of a level takes its j-th elimination step at once. The Python loop runs over the levels and steps only,
+    # about 2*sqrt(n) times for a 2-D stencil; a matrix whose rows form one long chain, like a bidiagonal one, has
+    # a level per row and gains nothing.
+    LU = sp.csr_matrix(A, dtype=float, copy=True)
+    LU.sum_duplicates() # also sorts the column indices of every row
+    indptr, indices, data = LU.indptr, LU.indices, LU.data
+    n = LU.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    on_diagonal = np.flatnonzero(indices == rows)
+    if on_diagonal.size != n:
+        missing = np.setdiff1d(np.arange(n), rows[on_diagonal])[0]
+        raise ValueError("ILU(0) needs every diagonal entry to be stored; row {} has none".format(missing))
+    diag_ptr = on_diagonal # the entries left of the diagonal come first in every row
+    lower_count = diag_ptr - indptr[:-1]
+    keys = rows.astype(np.int64)*n + indices # sorted, so searchsorted finds entry (i, j) of the pattern
+    # row i depends on row k for every lower entry a_ik; list the dependents of every row, CSR style
+    lower = indices < rows
+    order = np.argsort(indices[lower], kind="stable")
+    dependents = rows[lower][order]
+    dependents_ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices[lower], minlength=n), out=dependents_ptr[1:])
+    remaining = lower_count.copy()
+    level = np.flatnonzero(remaining == 0)
+    while level.size:
+        busy = level[lower_count[level] > 0]
+        for j in range(lower_count[busy].max() if busy.size else 0):
+            busy = busy[lower_count[busy] > j]
+            p = indptr[busy] + j # the j-th lower entry of every row, in column order
+            k = indices[p]
+            data[p] /= data[diag_ptr[k]]
+            # subtract l_ik times row k of U, but only where row i already has an entry
+            source = _ranges(diag_ptr[k] + 1, indptr[k + 1])
+            length = indptr[k + 1] - diag_ptr[k] - 1
+            target = np.repeat(busy.astype(np.int64), length)*n + indices[source]
+            pos = np.minimum(np.searchsorted(keys, target), len(keys) - 1)
+            hit = keys[pos] == target
+            data[pos[hit]] -= np.repeat(data[p], length)[hit]*data[source[hit]]
+        # the next level is every row whose last dependency was in this one
+        waiting, count = np.unique(dependents[_ranges(dependents_ptr[level], dependents_ptr[level + 1])],
+                                   return_counts=True)
+        remaining[waiting] -= count
+        level = waiting[remaining[waiting] == 0]
+    return LU
+
+class ILUPreconditioner(Preconditioner):
+    """
+    Incomplete LU factorization with zero fill, ILU(0), for sparse A. A dense A has no zeros to preserve,
+    so its ILU(0) is the complete LU factorization.
+    """
+    def __init__(self, A):
+        if sp.issparse(A):
+            LU = _ilu0(A)
+            lower_solve = _triangular_solver(sp.tril(LU, -1) + sp.eye(LU.shape[0]), True)
+            upper_solve = _triangular_solver(sp.triu(LU), False)
+            self.solve = lambda r: upper_solve(lower_solve(r))
+        else:
+            factors = lu_factor(A, check_finite=False)
+            self.solve = lambda r: lu_solve(factors, r, check_finite=False)
+
+    def apply(self, r, out):
+        out[...] = self.solve(r)
+        return out
+
+def make_preconditioner(A, kind, w=1.0):
+    """
+    Builds a preconditioner for A by name: "jacobi", "ssor" (with relaxation factor `w`) or "ilu".
+    `None` or "none" means no preconditioning, and an existing Preconditioner is returned unchanged.
+    """
+    if hasattr(kind, "apply"):
+        return kind
+    if kind is None or kind == "none":
+        return None
+    if kind == "jacobi":
+        return JacobiPreconditioner(A)
+    if kind == "ssor":
+        return SSORPreconditioner(A, w)
+    if kind == "ilu":
+        return ILUPreconditioner(A)
+    raise ValueError("Unknown preconditioner: {}".format(kind))
+
+def conjugate_gradient(A, B, row, col, M=None, max_iter=10000, time_limit=None, full_output=False, atol=0.01,
+                       rtol=0.0, x0=None):
+    """
+    Solves A*x = B with the conjugate gradient method. A must be symmetric positive definite, dense or sparse.
+    The residual vector is updated alongside the iterate, so each iteration costs a single matrix product, and
+    convergence is judged with the same residual norm and tolerance as the other solvers.
+    Every column of a block B gets its own step lengths.
+    `M` is an optional symmetric Preconditioner.
+    Tolerances, `x0`, the stopping rules and `full_output` are as described in `matrix_calculator`.
+    """
+    function = "Using the Conjugate Gradient method, the answer is:"
+    A = _submatrix(A, row, col)
+    b, single = _rhs_block(B, row)
+    monitor = _Monitor(max_iter, time_limit)
+    tol = _tolerance(b, atol, rtol)
+    answer = np.zeros(b.shape)
+    final_res = np.zeros(b.shape[1])
+    cols = np.arange(b.shape[1]) # the columns of B that have not converged yet
+    x = _initial_guess(x0, b)
+    r = np.empty(b.shape) # residual vectors, kept up to date by the recurrence below
+    res = residual(A, b, x, row, col, work=r)
+    z = r if M is None else M.apply(r, np.empty(b.shape)) # preconditioned residual
+    p = z.copy() # search directions
+    ap = np.empty(b.shape) # A*p
+    work = np.empty(b.shape)
+    rz = np.einsum("ij,ij->j", r, z)
+    while True:
+        keep = _retire_converged(res, x, cols, answer, final_res, monitor, tol)
+        if not keep.all():
+            cols = cols[keep]
+            if cols.size == 0:
+                break
+            b, x, r, p, rz = b[:, keep], x[:, keep], r[:, keep], p[:, keep], rz[keep]
+            z = r if M is None else np.empty(b.shape)
+            ap, work = np.empty(b.shape), np.empty(b.shape)
+        _matvec(A, p, ap)
+        alpha = rz/np.einsum("ij,ij->j", p, ap)
+        x += np.multiply(p, alpha, out=work)
+        r -= np.multiply(ap, alpha, out=work)
+        if M is not None:
+            M.apply(r, z)
+        rz_new = np.einsum("ij,ij->j", r, z)
+        p *= rz_new/rz
+        p += z
+        rz = rz_new
+        res = _norm(r, "l2", b)
+    return _result(function, answer, final_res, single, monitor, full_output)
+
+def gmres(A, B, row, col, restart=20, M=None, max_iter=10000, time_limit=None, full_output=False, atol=0.01,
+          rtol=0.0, x0=None):
+    """
+    Solves A*x = B with the restarted GMRES(m) method, where m is `restart`. A does not need to be symmetric.
+    The Krylov basis, Hessenberg matrix and rotations are allocated once and reused for every restart cycle and
+    every column of B. The residual estimate from the rotations is checked every iteration, and the true residual
+    is recomputed at each restart.
+    `M` is an optional Preconditioner, applied on the right so the residual being checked is still that of A*x = B.
+    The columns of B are solved one after another, each with up to `max_iter` iterations; "iterations" is the most
+    any column took. Tolerances, `x0`, the stopping rules and `full_output` are as described in `matrix_calculator`.
+    """
+    function = "Using the GMRES method, the answer is:"
+    A = _submatrix(A, row, col)
+    b, single = _rhs_block(B, row)
+    m = max(1, min(restart, row))
+    V = np.empty((m+1, row)) # Krylov basis, one vector per row so each one is contiguous
+    H = np.zeros((m+1, m)) # Hessenberg matrix, reduced to upper triangular form by the rotations
+    cs, sn = np.empty(m), np.empty(m) # Givens rotations
+    g = np.empty(m+1) # rotated right-hand side of the least squares problem
+    h = np.empty(m+1)
+    r = np.empty(row)
+    x = np.empty(row)
+    z = np.empty(row) # M^-1 times a basis vector
+    guess = _initial_guess(x0, b)
+    summary = _Monitor(max_iter, time_limit)
+    tol = _tolerance(b, atol, rtol)
+    answer = np.zeros(b.shape)
+    final_res = np.zeros(b.shape[1])
+    for k in range(b.shape[1]):
+        monitor = summary.column()
+        x[:] = guess[:, k]
+        res = residual(A, b[:, k], x, row, col, work=r)
+        while res > tol[k] and monitor.reason is None:
+            np.divide(r, res, out=V[0])
+            g[:] = 0
+            g[0] = res
+            j = 0
+            while j < m and abs(g[j]) > tol[k] and not monitor.stop(abs(g[j])):
+                w = V[j+1]
+                _matvec(A, V[j] if M is None else M.apply(V[j], z), w)
+                # classical Gram-Schmidt, so each pass is a pair of BLAS calls instead of a loop over the basis
+                np.dot(V[:j+1], w, out=h[:j+1])
+                w -= np.dot(h[:j+1], V[:j+1])
+                H[:j+1, j] = h[:j+1]
+                np.dot(V[:j+1], w, out=h[:j+1]) # a second pass restores the orthogonality lost to rounding
+                w -= np.dot(h[:j+1], V[:j+1])
+                H[:j+1, j] += h[:j+1]
+                H[j+1, j] = math.sqrt(np.dot(w, w))
+                if H[j+1, j] != 0:
+                    w /= H[j+1, j]
+                for i in range(j): # apply the earlier rotations to the new column
+                    temp = cs[i]*H[i, j] + sn[i]*H[i+1, j]
+                    H[i+1, j] = -sn[i]*H[i, j] + cs[i]*H[i+1, j]
+                    H[i, j] = temp
+                denom = math.hypot(H[j, j], H[j+1, j])
+                cs[j], sn[j] = H[j, j]/denom, H[j+1, j]/denom
+                H[j, j], H[j+1, j] = denom, 0.0
+                g[j+1] = -sn[j]*g[j]
+                g[j] = cs[j]*g[j]
+                j += 1
+            if j > 0:
+                y = solve_triangular(H[:j, :j], g[:j])
+                np.dot(y, V[:j], out=z)
+                x += z if M is None else M.apply(z, r) # r is recomputed just below, so it can hold M^-1 z for now
+            res = residual(A, b[:, k], x, row, col, work=r)
+        answer[:, k] = x
+        final_res[k] = res
+        summary.absorb(monitor)
+    return _result(function, answer, final_res, single, summary, full_output)
+
+def bicgstab(A, B, row, col, M=None, max_iter=10000, time_limit=None, full_output=False, atol=0.01, rtol=0.0,
+             x0=None):
+    """
+    Solves A*x = B with the BiCGSTAB method. A does not need to be symmetric.
+    All of the work vectors are allocated once and reused for every column of B.
+    `M` is an optional Preconditioner, applied on the right.
+    The columns of B are solved one after another, each with up to `max_iter` iterations; "iterations" is the most
+    any column took. Tolerances, `x0`, the stopping rules and `full_output` are as described in `matrix_calculator`.
+    """
+    function = "Using the BiCGSTAB method, the answer is:"
+    A = _submatrix(A, row, col)
+    b, single = _rhs_block(B, row)
+    r, r_hat, p, v, t = (np.empty(row) for _ in range(5))
+    p_hat, s_hat = (np.empty(row), np.empty(row)) if M is not None else (p, r) # preconditioned directions
+    x = np.empty(row)
+    work = np.empty(row)
+    guess = _initial_guess(x0, b)
+    summary = _Monitor(max_iter, time_limit)
+    tol = _tolerance(b, atol, rtol)
+    answer = np.zeros(b.shape)
+    final_res = np.zeros(b.shape[1])
+    for k in range(b.shape[1]):
+        monitor = summary.column()
+        x[:] = guess[:, k]
+        res = residual(A, b[:, k], x, row, col, work=r)
+        r_hat[:] = r # shadow residual
+        p[:], v[:] = 0, 0
+        rho = alpha = omega = 1.0
+        while res > tol[k] and not monitor.stop(res):
+            rho_new = np.dot(r_hat, r)
+            if rho_new == 0: # the shadow residual became orthogonal; start again from the current iterate
+                r_hat[:] = r
+                p[:], v[:] = 0, 0
+                rho = alpha = omega = 1.0
+                rho_new = np.dot(r_hat, r)
+            beta = (rho_new/rho)*(alpha/omega)
+            p -= np.multiply(v, omega, out=work) # p = r + beta*(p - omega*v)
+            p *= beta
+            p += r
+            if M is not None:
+                M.apply(p, p_hat)
+            _matvec(A, p_hat, v)
+            alpha = rho_new/np.dot(r_hat, v)
+            r -= np.multiply(v, alpha, out=work) # r now holds the intermediate residual s
+            x += np.multiply(p_hat, alpha, out=work)
+            res = _norm(r, "l2", b[:, k])
+            if res <= tol[k]:
+                break
+            if M is not None:
+                M.apply(r, s_hat)
+            _matvec(A, s_hat, t)
+            omega = np.dot(t, r)/np.dot(t, t)
+            x += np.multiply(s_hat, omega, out=work)
+            r -= np.multiply(t, omega, out=work)
+            res = _norm(r, "l2", b[:, k])
+            rho = rho_new
+        answer[:, k] = x
+        final_res[k] = res
+        summary.absorb(monitor)
+    return _result(function, answer, final_res, single, summary, full_output)
+
+def _content_key(A):
+    # A key that identifies A by its contents: the shape, the dtype and a hash of the stored values.
+    # Sparse matrices are hashed in canonical CSR form, so the same matrix in CSC or with unsorted indices matches.
+    digest = hashlib.blake2b(digest_size=16) if hasattr(hashlib, "blake2b") else hashlib.sha1()
+    if sp.issparse(A):
+        A = A.tocsr()
+        if not A.has_canonical_format:
+            A = A.copy()
+            A.sum_duplicates()
+        for part in (A.indptr, A.indices, A.data):
+            digest.update(np.ascontiguousarray(part).view(np.uint8))
+        return ("sparse", A.shape, A.dtype.str, digest.hexdigest())
+    A = np.ascontiguousarray(A)
+    digest.update(A.view(np.uint8))
+    return ("dense", A.shape, A.dtype.str, digest.hexdigest())
+
+class Factorization(object):
+    """
+    A factorization of A that solves A*x = B with two triangular solves. Dense matrices that are symmetric
+    positive definite get a Cholesky factorization, all others an LU factorization with partial pivoting.
+    Sparse matrices are factored by SuperLU; symmetric ones use its symmetric mode, which picks the pivots
+    on the diagonal as a Cholesky factorization would.
+    `kind` is "cholesky" or "lu", and `nbytes` is the memory the factors take.
+    Raises LinAlgError if A is singular.
+    """
+    def __init__(self, A):
+        if sp.issparse(A):
+            A = sp.csc_matrix(A, dtype=float)
+            symmetric = abs(A - A.T).max() == 0
+            options = dict(SymmetricMode=True) if symmetric else {}
+            try:
+                factor = spla.splu(A, permc_spec="MMD_AT_PLUS_A" if symmetric else "COLAMD",
+                                   diag_pivot_thresh=0.0 if symmetric else 1.0, options=options)
+            except RuntimeError as e: # SuperLU: "Factor is exactly singular"
+                raise LinAlgError(str(e))
+            self.kind = "lu"
+            self.nbytes = sum(T.data.nbytes + T.indices.nbytes + T.indptr.nbytes for T in (factor.L, factor.U))
+            self.solve = factor.solve
+            return
+        A = np.asarray(A, dtype=float)
+        # cho_factor only reads one triangle, so a matrix that is merely close to symmetric must go to LU
+        if np.array_equal(A, A.T) and np.all(np.diagonal(A) > 0):
+            try:
+                factors = cho_factor(A, check_finite=False)
+            except LinAlgError: # symmetric but not positive definite
+                pass
+            else:
+                self.kind = "cholesky"
+                self.nbytes = factors[0].nbytes
+                self.solve = lambda r: cho_solve(factors, r, check_finite=False)
+                return
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # a zero pivot is reported below instead
+            factors = lu_factor(A, check_finite=False)
+        if not np.all(np.diagonal(factors[0])):
+            raise LinAlgError("Matrix is singular")
+        self.kind = "lu"
+        self.nbytes = factors[0].nbytes + factors[1].nbytes
+        self.solve = lambda r: lu_solve(factors, r, check_finite=False)
+
+class FactorizationCache(object):
+    """
+    A least-recently-used cache of Factorizations, keyed by the contents of the matrix they factor.
+    Once the factors held take more than `max_bytes`, the least recently used ones are dropped; a factorization
+    larger than `max_bytes` on its own is never kept. `hits` and `misses` count the lookups.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def factor(self, A):
+        """Returns the Factorization of A and whether it came from the cache, factoring A on a miss."""
+        key = _content_key(A)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key], True
+        self.misses += 1
+        factors = Factorization(A)
+        if factors.nbytes <= self.max_bytes:
+            self._entries[key] = factors
+            self.nbytes += factors.nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last=False)[1].nbytes
+        return factors, False
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+factorization_cache = FactorizationCache() # shared by every direct solve in the process unless one is passed in
+
+def direct_solve(A, B, row, col, full_output=False, cache=None):
+    """
+    Solves A*x = B with a Cholesky (symmetric positive definite A) or LU factorization, see `Factorization`.
+    The factors are kept in `cache`, by default the module's `factorization_cache`, so solving again with the
+    same A and a new B only costs the two triangular solves. B may be a vector or an n x k block.
+    With `full_output` a third value is returned, a dict with "converged", "reason", "iterations" (always 0),
+    the final "residual", the "factorization" used and whether it was "cached".
+    A singular A has no answer: it is all NaN, and the reason is "singular".
+    """
+    if cache is None:
+        cache = factorization_cache
+    A = _submatrix(A, row, col)
+    b, single = _rhs_block(B, row)
+    try:
+        factors, cached = cache.factor(A)
+    except LinAlgError:
+        factors, cached = None, False
+        answer = np.full(b.shape, np.nan)
+    else:
+        answer = np.asarray(factors.solve(b)).reshape(b.shape)
+    kind = "lu" if factors is None else factors.kind
+    function = "Using the {} factorization, the answer is:".format("Cholesky" if kind == "cholesky" else "LU")
+    if single:
+        answer = answer[:, 0]
+    if not full_output:
+        return function, answer
+    singular = not np.all(np.isfinite(answer)) # overflow in the triangular solves means A is singular in practice
+    info = {"converged": not singular, "reason": "singular" if singular else "converged", "iterations": 0,
+            "history": [], "residual": residual(A, b[:, 0] if single else b, answer, row, col),
+            "factorization": kind, "cached": cached}
+    return function, answer, info
+
+def _scaled_abs(M, r, c):
+    # |diag(r) A diag(c)| for M = |A|, as a new dense array or sparse matrix
+    if sp.issparse(M):
+        return sp.diags(r).dot(M).dot(sp.diags(c)).tocsr()
+    return M * r[:, np.newaxis] * c
+
+def _max_abs(M, axis):
+    # The largest entry of every row (axis=1) or column (axis=0) of a nonnegative matrix, with 1 for empty ones
+    top = np.asarray(M.max(axis=axis).toarray() if sp.issparse(M) else M.max(axis=axis), dtype=float).ravel()
+    top[top == 0] = 1.0
+    return top
+
+def equilibrate(A, method="ruiz", iterations=20, tol=1e-3):
+    """
+    Computes diagonal scalings r and c such that diag(r) A diag(c) has rows (and columns) of comparable size.
+    `method` is "ruiz", which alternately divides every row and column by the square root of its largest entry
+    until all of them are within `tol` of 1 (at most `iterations` passes; a symmetric A stays symmetric), or "row",
+    which divides every row by its largest entry once and leaves the columns alone.
+    Returns the two scaling vectors.
+    """
+    M = abs(sp.csr_matrix(A, dtype=float)) if sp.issparse(A) else np.abs(np.asarray(A, dtype=float))
+    n, m = M.shape
+    r, c = np.ones(n), np.ones(m)
+    if method == "row":
+        return 1.0/_max_abs(M, 1), c
+    if method != "ruiz":
+        raise ValueError("Unknown scaling: {}".format(method))
+    for i in range(iterations):
+        S = _scaled_abs(M, r, c)
+        row_max, col_max = _max_abs(S, 1), _max_abs(S, 0)
+        if max(np.abs(1 - row_max).max(), np.abs(1 - col_max).max()) <= tol:
+            break
+        r /= np.sqrt(row_max)
+        c /= np.sqrt(col_max)
+    return r, c
+
+def matrix_calculator(A, B, row, col, solver_type, restart=20, preconditioner=None, precond_w=1.0, w=None,
+                      ordering="natural", max_iter=10000, time_limit=None, full_output=False, atol=0.01, rtol=0.0,
+                      check_every=1, criterion="residual", incremental=False, perm=None, scaling=None, x0=None):
+    """
+    Solves A*x = B with the solver picked by `solver_type` and returns the description of the method and the answer.
+    A may be a dense array or a scipy.sparse CSR/CSC matrix.
+    `restart` is the number of iterations GMRES runs before restarting.
+    `preconditioner` is used by the Krylov solvers (c, m and b): a name understood by `make_preconditioner`
+    ("jacobi", "ssor" with relaxation factor `precond_w`, or "ilu"), or a Preconditioner that was already built.
+    `w` is the relaxation factor of the Gauss-Siedel solver (s): a number, "auto" to estimate the optimal one, or
+    None for the default of 1.6.
+    `ordering` is the order in which the Gauss and Gauss-Siedel solvers sweep the unknowns: "natural" or "multicolor".
+    The iterative solvers share their stopping rules. B may be a vector or an n x k block of right-hand sides, and
+    a column drops out of the iteration once its residual is at most the larger of `atol` and `rtol` times the
+    norm of its B. The solve gives up after `max_iter` iterations, after `time_limit` seconds, or when the residual
+    diverges or stagnates; the last iterate is then returned and the message says why. `x0` is an optional initial
+    guess, a vector or one column per column of B; without it the iteration starts from zero.
+    With `full_output` a third value is returned, a dict with "converged", the "reason" it stopped, "iterations",
+    the final "residual" and, where the solver keeps one, the residual "history".
+    `check_every` (Gauss and Gauss-Siedel only) and `criterion` (Jacobi, Gauss and Gauss-Siedel) choose how often
+    and how convergence is checked, and `incremental` makes the Gauss and Gauss-Siedel sweeps keep the residual up
+    to date as they go.
+    `perm` is a row permutation for the Jacobi, Gauss and Gauss-Siedel solvers, or "auto" to find one with
+    `dominant_permutation`; the Krylov solvers and the direct solver (d) do not need one and ignore it.
+    The direct solver factors A once and keeps the factors in `factorization_cache`, so it ignores the iteration
+    and tolerance settings.
+    `scaling` ("ruiz" or "row", see `equilibrate`) solves the equilibrated system diag(r) A diag(c) y = diag(r) B
+    instead and returns x = diag(c) y, so that the tolerances apply to residuals of comparable size in every row.
+    For the Conjugate Gradient solver r and c are replaced by their geometric mean, which keeps A symmetric.
+    The reported "residual" is still that of the original system, and the one of the scaled system is kept as
+    "scaled_residual". A solve whose scaled system converged but whose original residual is above the tolerance
+    has not converged, with the reason "scaled_only".
+    """
+    if scaling is not None and scaling != "none":
+        A = _submatrix(A, row, col)
+        r, c = equilibrate(A, scaling)
+        if solver_type == "c":
+            # conjugate gradient needs the scaled matrix to stay symmetric, so the rows and columns are scaled
+            # alike; this leaves a Ruiz scaling of a symmetric A as it is and turns "row" into diag(sqrt(r)) on both
+            r = c = np.sqrt(r*c)
+        scaled = sp.diags(r).dot(A).dot(sp.diags(c)) if sp.issparse(A) else A * r[:, np.newaxis] * c
+        b = np.asarray(B, dtype=float)[:row]
+        if x0 is not None: # the scaled system is solved for y = diag(c)^-1 x
+            x0 = _checked_guess(x0, col)
+            x0 = x0/(c if x0.ndim == 1 else c[:, np.newaxis])
+        result = matrix_calculator(scaled, b * (r if b.ndim == 1 else r[:, np.newaxis]), row, col, solver_type,
+                                   restart=restart, preconditioner=preconditioner, precond_w=precond_w, w=w,
+                                   ordering=ordering, max_iter=max_iter, time_limit=time_limit,
+                                   full_output=full_output, atol=atol, rtol=rtol, check_every=check_every,
+                                   criterion=criterion, incremental=incremental, perm=perm, x0=x0)
+        answer = result[1] * (c if result[1].ndim == 1 else c[:, np.newaxis])
+        if full_output:
+            info = result[2]
+            info["scaled_residual"], info["residual"] = info["residual"], residual(A, b, answer, row, col)
+            # the solver only saw the scaled system; the solve has converged if the original one meets the tolerances
+            if info["converged"] and np.any(info["residual"] > _tolerance(b.reshape(row, -1), atol, rtol)):
+                info["converged"], info["reason"] = False, "scaled_only"
+        return (result[0], answer) + tuple(result[2:])
+    limits = dict(max_iter=max_iter, time_limit=time_limit, full_output=full_output, atol=atol, rtol=rtol, x0=x0)
+    if solver_type in ("c", "m", "b", "d"):
+        perm = None
+    elif isinstance(perm, str) and perm == "auto":
+        perm = dominant_permutation(_submatrix(A, row, col))
     if solver_type == "g": # G IS A PLACEHOLDER FOR COMMAND LINE PARSER "CHOICES" ISSUE RESOLUTION
         w = 1.0
-        state, answer = gauss_siedel(A, B, row, col, w)
+        result = gauss_siedel(A, B, row, col, w, ordering, check_every=check_every, criterion=criterion,
+                              incremental=incremental, perm=perm, **limits)
     elif solver_type == "s": # S IS A PLACEHOLDER FOR COMMAND LINE PARSER "CHOICES" ISSUE RESOLUTION
-        w = 1.6 #this number was chosen because it is the most efficient number for Gauss-Siedel method, according to Dr. Nagrath
-        state, answer = gauss_siedel(A, B, row, col, w)
+        if w is None:
+            w = 1.6 #this number was chosen because it is the most efficient number for Gauss-Siedel method, according to Dr. Nagrath
+        result = gauss_siedel(A, B, row, col, w, ordering, check_every=check_every, criterion=criterion,
+                              incremental=incremental, perm=perm, **limits)
+    elif solver_type in ("c", "m", "b"):
+        M = make_preconditioner(_submatrix(A, row, col), preconditioner, precond_w)
+        if solver_type == "c":
+            result = conjugate_gradient(A, B, row, col, M, **limits)
+        elif solver_type == "m":
+            result = gmres(A, B, row, col, restart, M, **limits)
+        else:
+            result = bicgstab(A, B, row, col, M, **limits)
+    elif solver_type == "d":
+        result = direct_solve(A, B, row, col, full_output) # a direct solve has no use for x0
     else:
         # J IS A PLACEHOLDER FOR COMMAND LINE PARSER "CHOICES" ISSUE RESOLUTION
-        state, answer = jacobi(A, B, row, col)
+        result = jacobi(A, B, row, col, criterion=criterion, perm=perm, **limits)
+
+    return result
+
+class Solver(object):
+    """
+    Solves A*x = B for one matrix A and a sequence of right-hand sides, such as the steps of a time-stepping loop
+    or the requests of a service. Everything that only depends on A is worked out once, when the Solver is built:
+    the shape checks, the diagonal dominance report (`dominance`), the inverse diagonal and, for Gauss and
+    Gauss-Siedel, the split of A into the triangular part D/w + L and the rest.
+    `solver_type` and the keyword `options` are those of `matrix_calculator`. Jacobi, Gauss and Gauss-Siedel with
+    none of the extra options run in the Solver's own loop over work buffers that it keeps between calls, so with a
+    dense A a solve allocates nothing of the size of A or B (scipy's sparse products and triangular solves return
+    new arrays); any other method or option is handed to `matrix_calculator`.
+    Every solve starts from the answer of the previous one with as many right-hand sides, so when B only changes a
+    little between calls each solve takes a handful of iterations.
+    After a solve, `x` holds the answer, `message` the description of the method and `info` the record of how the
+    solve went (see `matrix_calculator` with `full_output`). `x` belongs to the Solver and is overwritten by the
+    next solve. `reset` makes the next solve start from zero.
+    """
+    def __init__(self, A, solver_type="j", w=None, max_iter=10000, time_limit=None, atol=0.01, rtol=0.0,
+                 **options):
+        A = sp.csr_matrix(A, dtype=float) if sp.issparse(A) else np.asarray(A, dtype=float)
+        row, col = A.shape
+        if row != col:
+            raise ValueError("A must be square to build a Solver, not {} x {}".format(row, col))
+        self.A = A
+        self.shape = A.shape
+        self.solver_type = solver_type
+        self.limits = dict(max_iter=max_iter, time_limit=time_limit, atol=atol, rtol=rtol)
+        self.options = options
+        self.dominance = diagonal_dominance(A) if solver_type in ("j", "g", "s") else None
+        auto = False
+        if solver_type == "g":
+            w = 1.0
+        elif solver_type == "s":
+            auto = w == "auto"
+            w = optimal_omega(A) if auto else (1.6 if w is None else w)
+        self.w = w
+        self._own_loop = solver_type in ("j", "g", "s") and not options
+        self._buffers = {} # work buffers for every number of right-hand sides solved so far
+        diag = _diagonal(A, row)
+        if solver_type == "j":
+            self.function = "Using the Jacobi method, the answer is:"
+            self.inv_diag = (1.0/diag)[:, np.newaxis]
+        elif solver_type in ("g", "s"):
+            if auto: # the same messages as `gauss_siedel`
+                self.function = "Using the Gauss-Siedel method with w = {:.4f}, the answer is:".format(w)
+            else:
+                self.function = "Using the {} method, the answer is:".format("Gauss" if w == 1.0 else "Gauss-Siedel")
+            # (D/w + L) x_new = B + N x with N = (1/w - 1) D - U is one SOR sweep, done by a compiled triangular
+            # solve; since A = (D/w + L) - N, the residual of x_new is N (x_new - x) and comes with the next sweep
+            if sp.issparse(A):
+                lower = sp.tril(A, -1) + sp.diags(diag/w)
+                self.N = (sp.diags((1.0/w - 1.0)*diag) - sp.triu(A, 1)).tocsr()
+                self.lower_solve = _triangular_solver(lower, True)
+            else:
+                lower = np.asfortranarray(np.tril(A, -1) + np.diag(diag/w))
+                self.N = np.diag((1.0/w - 1.0)*diag) - np.triu(A, 1)
+                self.lower_solve = lambda r: solve_triangular(lower, r, lower=True, overwrite_b=True,
+                                                              check_finite=False)
+        self.reset()
+
+    def reset(self):
+        for buffers in self._buffers.values():
+            buffers[0][...] = 0
+        self.x = None
+        self.message = None
+        self.info = None
+
+    def _workspace(self, k):
+        # The iterate and scratch blocks for k right-hand sides, allocated on the first solve with k columns. They are
+        # C-ordered, since np.dot only writes into a C-contiguous `out`; the last one is the Fortran-ordered
+        # right-hand side that solve_triangular overwrites with the answer of a dense sweep
+        if k not in self._buffers:
+            shape = (self.shape[0], k)
+            self._buffers[k] = tuple(np.zeros(shape) for _ in range(4)) + (np.zeros(shape, order="F"),)
+        return self._buffers[k]
 
-    return state, answer
+    def solve(self, B):
+        """Solves A*x = B, warm-starting from the last answer with as many right-hand sides as B, and returns x."""
+        row, col = self.shape
+        if not self._own_loop:
+            x0 = self.x
+            if x0 is not None and np.size(x0) not in (col, np.size(B)):
+                x0 = None # a different number of right-hand sides than last time
+            options = dict(self.limits, w=self.w, **self.options)
+            self.message, self.x, self.info = matrix_calculator(self.A, B, row, col, self.solver_type,
+                                                                full_output=True, x0=x0, **options)
+            return self.x
+        b, single = _rhs_block(B, row)
+        x, r, t, t_new, rhs = self._workspace(b.shape[1])
+        monitor = _Monitor(self.limits["max_iter"], self.limits["time_limit"])
+        tol = _tolerance(b, self.limits["atol"], self.limits["rtol"])
+        _matvec(self.A, x, r)
+        np.subtract(b, r, out=r)
+        if self.solver_type != "j":
+            _matvec(self.N, x, t) # N x, the part of the next sweep's right-hand side that the iterate contributes
+        while True:
+            res = _norm(r, "l2", b)
+            if np.all(res <= tol):
+                monitor.history.append(float(np.max(res)))
+                break
+            if monitor.stop(res[res > tol]):
+                break
+            if self.solver_type == "j":
+                r *= self.inv_diag # x_new = x + D^-1 (B - A x)
+                x += r
+                _matvec(self.A, x, r)
+                np.subtract(b, r, out=r)
+            else:
+                np.add(b, t, out=rhs)
+                x[...] = self.lower_solve(rhs)
+                _matvec(self.N, x, t_new)
+                np.subtract(t_new, t, out=r)
+                t, t_new = t_new, t
+        if self.solver_type != "j":
+            self._buffers[b.shape[1]] = (x, r, t, t_new, rhs) # keep N x next to the iterate it belongs to
+        self.message, self.x, self.info = _result(self.function, x, res, single, monitor, True)
+        if self.solver_type != "j":
+            self.info["omega"] = self.w
+        return self.x
+
+def batch_calculator(A, B, solver_type, max_iter=10000, time_limit=None, full_output=False, atol=0.01, rtol=0.0):
+    """
+    Solves a stack of independent systems A[s]*x[s] = B[s] at once, where A is (batch, n, n) and B is (batch, n).
+    `solver_type` picks the method the same way as in `matrix_calculator`. Every sweep is done for the whole stack
+    with vectorized operations; a system stops being swept as soon as its own residual has converged.
+    A system has converged once its residual is at most the larger of `atol` and `rtol` times the norm of its B.
+    A system also stops, with its last iterate, after `max_iter` iterations or once its residual diverges, and every
+    system stops after `time_limit` seconds.
+    Returns the description of the method, the (batch, n) answers and the number of iterations each system took.
+    With `full_output` a fourth value is returned, a dict with the per-system "converged" mask and final "residual".
+    """
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    if solver_type == "g":
+        w = 1.0
+        function = "Using the Gauss method, the answers are:"
+    elif solver_type == "s":
+        w = 1.6 # the same relaxation factor that matrix_calculator uses
+        function = "Using the Gauss-Siedel method, the answers are:"
+    else:
+        w = None
+        function = "Using the Jacobi method, the answers are:"
+    batch, n = B.shape
+    deadline = None if time_limit is None else time.time() + time_limit
+    answer = np.zeros((batch, n))
+    iterations = np.zeros(batch, dtype=int)
+    converged = np.zeros(batch, dtype=bool)
+    final_res = np.zeros(batch)
+    active = np.arange(batch) # the systems that are still being swept
+    diag = np.diagonal(A, axis1=1, axis2=2).copy()
+    x = np.zeros((batch, n))
+    ax = np.empty((batch, n, 1)) # A*x for every running system
+    first = None # the starting residual of every running system, to detect divergence
+    tol = np.maximum(atol, rtol*np.sqrt(np.einsum("si,si->s", B, B)))
+    while True:
+        np.matmul(A, x[:, :, np.newaxis], out=ax)
+        r = B - ax[:, :, 0]
+        res = np.sqrt(np.einsum("si,si->s", r, r))
+        if first is None:
+            first = res
+        done = res <= tol
+        converged[active[done]] = True
+        failed = ~np.isfinite(res) | (res > 1e8*first) | (iterations[active] >= max_iter)
+        if deadline is not None and time.time() > deadline:
+            failed[:] = True
+        keep = ~(done | failed)
+        if not keep.all():
+            # The stack is only compacted when a system stops, not on every sweep
+            answer[active[~keep]] = x[~keep]
+            final_res[active[~keep]] = res[~keep]
+            active = active[keep]
+            if active.size == 0:
+                break
+            A, B, diag, x, r, first, tol = A[keep], B[keep], diag[keep], x[keep], r[keep], first[keep], tol[keep]
+            ax = np.empty((active.size, n, 1))
+        if w is None:
+            x = x + r/diag # x_new = D^-1 (B - (A - D) x_old), written in terms of the residual
+        else:
+            for i in range(n): # each unknown is updated for every system in the stack at once
+                term = np.einsum("sj,sj->s", A[:, i, :], x) - diag[:, i]*x[:, i]
+                x[:, i] = (x[:, i] - w*x[:, i]) + (w/diag[:, i])*(B[:, i] - term)
+        iterations[active] += 1
+    if full_output:
+        return function, answer, iterations, {"converged": converged, "residual": final_res}
+    return function, answer, iterations
 
-def diagonally_dominant_check(A):
+DominanceReport = namedtuple("DominanceReport", ["dominant", "rows", "margin"])
+
+def _row_sums(A, block=2**22):
+    # The sum of |a_ij| over every row; for sparse A only the stored entries are visited, so the cost is O(nnz).
+    # A dense A is taken a block of rows (about `block` entries) at a time, so the temporaries stay small even when
+    # A is a memory-mapped file far larger than memory.
+    if sp.issparse(A):
+        return np.asarray(abs(A).sum(axis=1), dtype=float).ravel()
+    total = np.empty(A.shape[0])
+    step = max(1, block//max(1, A.shape[1]))
+    for start in range(0, A.shape[0], step):
+        total[start:start+step] = np.abs(A[start:start+step]).sum(axis=1)
+    return total
+
+def diagonal_dominance(A, strict=False, perm=None):
+    """
+    Compare |a_ii| against the sum over j != i of |a_ij| for every row of A, dense or sparse.
+    Returns a DominanceReport with the verdict, the offending row indices and the margin
+    |a_ii| - sum_{j != i} |a_ij| of every row. Weak dominance also needs one strictly dominant row; when that is
+    all that is missing, no row is offending and `rows` is empty.
+    With a row permutation `perm` the report is for A[perm], which is not formed.
+    """
+    if sp.issparse(A):
+        A = A.tocsr()
+    else:
+        A = np.asarray(A) # a view, not a copy, of a memory-mapped A
+    n = A.shape[0]
+    diag = np.abs(_diagonal(A, n, perm))
+    total = _row_sums(A)
+    if perm is not None:
+        total = total[perm]
+    margin = 2 * diag - total
+    if strict:
+        rows = np.flatnonzero(margin <= 0)
+        dominant = rows.size == 0
+    else:
+        rows = np.flatnonzero(margin < 0)
+        dominant = rows.size == 0 and bool(np.any(margin > 0))
+    return DominanceReport(dominant, rows, margin)
+
+def diagonally_dominant_check(A, strict=False):
     # For any of the solving methods used in this code, the matrix A must be diagonally dominant.
     # This function will test to make sure that the matrix is diagonally dominant
-    row, col = np.shape(A)
-    max_value = np.zeros(row)
-    verdict = True # Assume True until proven "guilty"/ False
-    for i in range(row):
-        max_value[i] = abs(A[i,i])
-        for j in range(col):
-            if abs(A[i,j]) > max_value[i]:
-                max_value[i] = 999
+    return diagonal_dominance(A, strict).dominant
+
+def dominant_permutation(A):
+    """
+    Finds a row permutation `perm` that puts large entries of A on the diagonal, so that A[perm] is diagonally
+    dominant whenever some row order makes it so.
+    Entry a_ij can only be the diagonal of a dominant row if 2|a_ij| >= sum_j |a_ij|, so a perfect bipartite
+    matching between rows and columns over those entries gives a dominant order if there is one. When there is
+    none, a weighted matching that maximizes the product of the diagonal entries relative to their row sums is
+    used instead, as the best remaining order.
+    Returns an index array with perm[i] the row of A that becomes row i; raises ValueError if A is structurally
+    singular.
+    """
+    if np.shape(A)[0] != np.shape(A)[1]:
+        raise ValueError("A must be square to reorder its rows, not {} x {}".format(*np.shape(A)))
+    G = abs(sp.csr_matrix(A, dtype=float))
+    G.eliminate_zeros()
+    n = G.shape[0]
+    total = _row_sums(G)
+    rows = np.repeat(np.arange(n), np.diff(G.indptr))
+    candidates = G.copy()
+    candidates.data = (2 * G.data >= total[rows]).astype(float)
+    candidates.eliminate_zeros()
+    perm = csgraph.maximum_bipartite_matching(candidates, perm_type="row")
+    if np.all(perm >= 0):
+        return perm
+    # -log of the entries relative to their row sums, shifted by 1 so that no edge has weight zero
+    G.data = 1.0 + np.log(total[rows]) - np.log(G.data)
+    try:
+        row_ind, col_ind = csgraph.min_weight_full_bipartite_matching(G)
+    except AttributeError: # scipy < 1.6: settle for any order with a nonzero diagonal
+        perm = csgraph.maximum_bipartite_matching(G, perm_type="row")
+        if np.any(perm < 0):
+            raise ValueError("The matrix is structurally singular, no row order gives it a nonzero diagonal")
+        return perm
+    except ValueError:
+        raise ValueError("The matrix is structurally singular, no row order gives it a nonzero diagonal")
+    perm = np.empty(n, dtype=int)
+    perm[col_ind] = row_ind
+    return perm
 
-    if 999 in max_value:
-        verdict = False # If the matrix is not diagonally dominant, the verdict is False; if it is DD, verdict is True
+def omega_type(value):
+    # argparse type for the relaxation factor: a number, or "auto"
+    if value == "auto":
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a number or 'auto', not '{}'".format(value))
+
+def positive_int_type(value):
+    # argparse type for a count that must be at least 1
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a whole number, not '{}'".format(value))
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not {}".format(value))
+    return value
+
+def _add_solver_arguments(parser):
+    # The options that choose and tune the solver, shared by the single-system command line and `matcalc batch`
+    parser.add_argument("-s", "--solver", choices=("j","g", "s", "c", "m", "b", "d"),
+                        help="Use these options to help you choose a solver: j for Jacobi, g for Gauss, s for Gauss-Siedel, c for Conjugate Gradient (A must be symmetric positive definite), m for GMRES, b for BiCGSTAB, d for a direct LU or Cholesky factorization. Jacobi is the default.",
+                        default="j")
+    parser.add_argument("-w", "--omega", type=omega_type, default=None,
+                        help="The relaxation factor of the Gauss-Siedel solver, or 'auto' to estimate the optimal one from the matrix. The default is 1.6.")
+    parser.add_argument("-o", "--ordering", choices=("natural", "multicolor"), default="natural",
+                        help="The order in which the g and s solvers update the unknowns: natural, or multicolor to update every unknown of one color (red-black for stencil matrices) at once. The default is natural.")
+    parser.add_argument("--max-iter", type=int, default=10000,
+                        help="The most iterations a solver may take before it gives up. The default is 10000.")
+    parser.add_argument("--time-limit", type=float, default=None,
+                        help="The most seconds a solver may take before it gives up. By default there is no limit.")
+    parser.add_argument("--atol", type=float, default=0.01,
+                        help="The absolute residual error below which a solve has converged. The default is 0.01.")
+    parser.add_argument("--rtol", type=float, default=0.0,
+                        help="The residual error relative to the norm of B below which a solve has converged; the larger of the two tolerances is used. The default is 0.")
+    parser.add_argument("--check-every", type=positive_int_type, default=1,
+                        help="How many g or s sweeps to run between residual checks. The default is 1.")
+    parser.add_argument("--criterion", choices=("residual", "update"), default="residual",
+                        help="What the j, g and s solvers compare with the tolerance: the residual, or the size of the change made by the last sweep, which is cheaper. The default is residual.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Keep the residual up to date during the g and s sweeps instead of recomputing it after each one.")
+    parser.add_argument("--scaling", choices=("none", "row", "ruiz"), default="none",
+                        help="Equilibrate A before solving: row to divide every row by its largest entry, ruiz to balance the rows and columns. The default is none.")
+    parser.add_argument("-r", "--restart", type=int, default=20,
+                        help="The number of iterations between restarts of the GMRES solver. The default is 20.")
+    parser.add_argument("-p", "--preconditioner", choices=("none", "jacobi", "ssor", "ilu"), default="none",
+                        help="The preconditioner used by the c, m and b solvers: jacobi for the diagonal, ssor for symmetric successive over-relaxation, ilu for an incomplete LU factorization. The default is none.")
+    parser.add_argument("--precond-omega", type=float, default=1.0,
+                        help="The relaxation factor of the ssor preconditioner, between 0 and 2. The default is 1.0.")
 
-    return verdict
+def _precond_omega_ok(args):
+    # The ssor preconditioner needs 0 < w < 2; says so on stderr when --precond-omega is outside that range
+    if args.preconditioner == "ssor" and not 0 < args.precond_omega < 2:
+        warning("The ssor relaxation factor must be between 0 and 2:", args.precond_omega)
+        return False
+    return True
+
+def _solver_options(args):
+    # The keyword arguments of `matrix_calculator` that come straight from the solver options on the command line
+    return dict(restart=args.restart, preconditioner=args.preconditioner, precond_w=args.precond_omega, w=args.omega,
+                ordering=args.ordering, max_iter=args.max_iter, time_limit=args.time_limit, atol=args.atol,
+                rtol=args.rtol, check_every=args.check_every, criterion=args.criterion, incremental=args.incremental)
 
 def parse_cmdline(argv):
     """
@@ -137,12 +1813,24 @@ def parse_cmdline(argv):
     #                     default=DEF_IRATE_FILE, type=read_input_rates)
     #parser.add_argument("-n", "--no_attribution", help="Whether to include attribution",
                         # action='store_false')
-    parser.add_argument("-s", "--solver", choices=("j","g", "s"),
-                        help="Use these options to help you choose a solver: j for Jacobi, g for Gauss, s for Gauss-Siedel. Jacobi is the default.",
-                        default="j")
-    parser.add_argument("A", help="This is the main A matrix, as in Ax=B. Format as: '1,2,3;4,5,6;7,8,9' to create this, where ; separates the rows and , separates the columns. Make sure that the number of columns in this matrix A are the same as the number of rows in matrix B. THIS MATRIX MUST BE DIAGONALLY DOMINANT FOR THESE METHODS TO WORK!",
+    _add_solver_arguments(parser)
+    parser.add_argument("--scaling-report", action="store_true",
+                        help="Also solve without scaling and print how many iterations the scaling saved.")
+    parser.add_argument("--x0", default=None,
+                        help="A file with an initial guess for the iterative solvers: a .npy file, or text with one value per row (one column per column of B). By default the solvers start from zero.")
+    parser.add_argument("--output", default=None,
+                        help="Write the answer to this file instead of printing it: a .npy file, or raw little-endian float64 values for any other name.")
+    parser.add_argument("--output-format", choices=("npy", "raw", "memmap"), default=None,
+                        help="The format of --output: npy, raw, or memmap for a .npy file written through a memory map. By default it follows the file name.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print one JSON record (a line of NDJSON) with the method, omega, iterations, residual and timings instead of the sentence and the answer.")
+    parser.add_argument("--A-file", default=None,
+                        help="Read A from a file instead of the A argument: a .npy file (memory-mapped), a .npz archive (including sparse matrices saved by scipy), a Matrix Market .mtx file, or raw little-endian float64 values of a square matrix, also memory-mapped.")
+    parser.add_argument("--B-file", default=None,
+                        help="Read B from a file instead of the B argument, in the same formats as --A-file; raw values are split into as many rows as A has.")
+    parser.add_argument("A", nargs="?", default=None, help="This is the main A matrix, as in Ax=B. Format as: '1,2,3;4,5,6;7,8,9' to create this, where ; separates the rows and , separates the columns. Make sure that the number of columns in this matrix A are the same as the number of rows in matrix B. THIS MATRIX MUST BE DIAGONALLY DOMINANT FOR THESE METHODS TO WORK! If it is not, the rows are reordered to make it so when possible. Entries may also be separated by spaces and rows by line breaks, and '-' reads the matrix from standard input.",
                         action=StoreAsArray)
-    parser.add_argument("B", help="This is the answer B matrix, as in Ax=B.  Format as: '1;2;3' to create this, where ; separates the rows. Make sure that the number of rows in this matrix A are the same as the number of columns in matrix A.",
+    parser.add_argument("B", nargs="?", default=None, help="This is the answer B matrix, as in Ax=B.  Format as: '1;2;3' to create this, where ; separates the rows. Make sure that the number of rows in this matrix A are the same as the number of columns in matrix A. To solve for several right-hand sides at once, give B one column per system, e.g. '1,4;2,5;3,6'. '-' reads B from standard input.",
                         action=StoreAsArray)
 
     args = None
@@ -150,35 +1838,332 @@ def parse_cmdline(argv):
 
     try: # makes sure that the Store_as_array function is working
         args = parser.parse_args(argv)
-        assert isinstance(args.A, np.ndarray)
+        # a matrix file takes the place of the matching argument, and when only B is given as text,
+        # argparse has stored it as A
+        if args.A_file is not None and args.B is not None:
+            raise ValueError("give A either as an argument or with --A-file, not both")
+        if args.B_file is not None and args.B is not None:
+            raise ValueError("give B either as an argument or with --B-file, not both")
+        if args.A_file is not None and args.B is None:
+            args.A, args.B = None, args.A
+        if args.A_file is not None:
+            args.A = _load_system_file(args.A_file, "A")
+        if args.B_file is not None:
+            args.B = _load_system_file(args.B_file, "B", np.shape(args.A)[0] if args.A is not None else None)
+        if args.A is None or args.B is None:
+            raise ValueError("give A and B, either as arguments or with --A-file and --B-file")
+        assert isinstance(args.A, np.ndarray) or sp.issparse(args.A)
         assert isinstance(args.B, np.ndarray)
     except TypeError as t:
         warning("A and B must be of the same type:", t)
         parser.print_help()
         return args, 2
+    except (IOError, ValueError) as v:
+        warning("Could not read the matrix:", v)
+        parser.print_help()
+        return args, 2
 
-    try: # makes sure that the matrices have identical dimensions
-        dimen_test = np.dot(args.A, args.B)
-    except ValueError as v:
-        warning("Matrices must have identical inside dimension:", v)
+    # makes sure that the matrices have identical dimensions, by shape alone so a large A is not read here
+    dimen_test = np.shape(args.A)[1] == np.shape(args.B)[0]
+    if not dimen_test:
+        warning("Matrices must have identical inside dimension:",
+                "A is {} x {} but B has {} rows".format(np.shape(args.A)[0], np.shape(args.A)[1], np.shape(args.B)[0]))
         parser.print_help()
         return dimen_test, 2
+    if np.shape(args.A)[0] != np.shape(args.A)[1]:
+        warning("Matrix must be square:", "A is {} x {}".format(np.shape(args.A)[0], np.shape(args.A)[1]))
+        parser.print_help()
+        return args, 2
+
+    if not _precond_omega_ok(args):
+        parser.print_help()
+        return args, 2
+
+    if args.x0 is not None: # reads the initial guess and makes sure it has one value per unknown
+        try:
+            if os.path.splitext(args.x0)[1].lower() in (".npy", ".npz"):
+                args.x0 = load_array(args.x0)
+            else:
+                args.x0 = np.loadtxt(args.x0, ndmin=1)
+            if np.shape(args.x0)[0] != np.shape(args.A)[1]:
+                raise ValueError("expected {} rows, got {}".format(np.shape(args.A)[1], np.shape(args.x0)[0]))
+        except (IOError, ValueError) as e:
+            warning("Could not read the initial guess:", e)
+            parser.print_help()
+            return args, 2
 
     return args, 0
 
 
+_SOLVER_NAMES = {"j": "jacobi", "g": "gauss", "s": "gauss-siedel", "c": "conjugate-gradient", "m": "gmres",
+                 "b": "bicgstab", "d": "direct"}
+
+def _to_json(value):
+    # Numbers and arrays from the solvers as plain JSON values; NaN and infinities, which JSON has no words for,
+    # become null
+    value = np.asarray(value)
+    if value.dtype.kind == "f" and not np.all(np.isfinite(value)):
+        value = np.where(np.isfinite(value), value, None)
+    return value.item() if value.ndim == 0 else value.tolist()
+
+def result_record(solver_type, info, timings=None, answer=None, output=None):
+    """
+    Builds the structured record of one solve from the `full_output` dict of `matrix_calculator`: the "method",
+    relaxation factor "omega" (null if the method has none), "converged", "reason", "iterations", final
+    "residual" (and "scaled_residual" for a scaled solve), a dict of "timings" in seconds and where the answer
+    went, either an "output" file or the answer "x" itself. `json.dumps` turns it into one line of NDJSON.
+    """
+    record = {"method": _SOLVER_NAMES.get(solver_type, solver_type), "omega": info.get("omega"),
+              "converged": bool(info["converged"]), "reason": info["reason"], "iterations": int(info["iterations"]),
+              "residual": _to_json(info["residual"]), "timings": timings or {}}
+    if "factorization" in info:
+        record["method"] = info["factorization"]
+    if "scaled_residual" in info:
+        record["scaled_residual"] = _to_json(info["scaled_residual"])
+    if output is not None:
+        record["output"] = output
+    elif answer is not None:
+        record["x"] = _to_json(answer)
+    return record
+
+def _is_symmetric(A):
+    # Whether A equals its transpose up to rounding, for dense or sparse A
+    if sp.issparse(A):
+        return abs(A - A.T).max() <= 1e-8*abs(A).max()
+    return np.allclose(A, A.T)
+
+def _screen_system(A, solver_type):
+    # The stationary methods need a diagonally dominant matrix; screen it once before dispatching, and if it fails
+    # see whether reordering the rows of A fixes it. Returns why A cannot be solved with `solver_type` (or None) and
+    # the row permutation to solve it with (or None)
+    dominance = diagonal_dominance(A) if solver_type in ("j", "g", "s") else None
+    perm = None
+    if dominance is not None and not dominance.dominant:
+        try:
+            perm = dominant_permutation(A)
+        except ValueError:
+            perm = None
+        else:
+            reordered = diagonal_dominance(A, perm=perm)
+            if reordered.dominant:
+                dominance = reordered
+            else:
+                perm = None
+    if solver_type == "c" and not _is_symmetric(A):
+        # conjugate gradient needs a symmetric positive definite matrix rather than a diagonally dominant one
+        return "Matrix must be symmetric for the Conjugate Gradient method:", None
+    if dominance is not None and not dominance.dominant:
+        if dominance.rows.size == 0: # every row is weakly dominant, but none strictly
+            return "Matrix must be diagonally dominant (no row is strictly dominant):", None
+        return "Matrix must be diagonally dominant (failing rows: {}):".format(dominance.rows), None
+    return None, perm
+
+_END = object() # closes a pipeline queue
+
+def _read_ahead(systems, outbox, failures):
+    # The reading stage of `solve_systems`: puts every system on `outbox` together with the seconds it took to read
+    try:
+        systems = iter(systems)
+        while True:
+            start = time.time()
+            try:
+                system = next(systems)
+            except StopIteration:
+                break
+            outbox.put((system, time.time() - start))
+    except BaseException as e: # raised again by the solving thread once everything read so far is solved
+        failures.append(e)
+    finally:
+        outbox.put(_END)
+
+def _write_behind(inbox, out, output_format, failures):
+    # The writing stage of `solve_systems`: writes the answer of every record, to a file or into the record itself,
+    # and the record as one line of NDJSON, in the order the records arrive. An answer file that cannot be written
+    # becomes the error of its record; only a failure to write to `out` stops the output
+    while True:
+        item = inbox.get()
+        if item is _END:
+            return
+        if failures:
+            continue # keep draining, so the solving thread is never left waiting on a full queue
+        record, answer, path = item
+        if answer is not None and path is not None:
+            try:
+                start = time.time()
+                write_array(path, answer, output_format)
+                record["timings"]["write"] = time.time() - start
+                record["output"] = path
+            except Exception as e:
+                record["error"] = _error_text(e)
+        elif answer is not None:
+            record["x"] = _to_json(answer)
+        try:
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+        except BaseException as e:
+            failures.append(e)
+
+def solve_systems(systems, solver_type="j", out=None, output_dir=None, output_format=None, depth=4, **options):
+    """
+    Solves a stream of systems, such as the BatchSystem tuples from `read_systems`, and writes one NDJSON record per
+    system to `out` (standard output by default), in the order the systems came in.
+    The work is pipelined: one thread reads the next systems while this one solves and another writes the records,
+    with at most `depth` systems waiting at each step, so reading and writing are hidden behind the solves.
+    `options` are passed on to `matrix_calculator` (w, ordering, max_iter, atol, scaling, ...). Every system is
+    screened like on the command line, with its rows reordered when that makes it diagonally dominant.
+    Each record is the `result_record` of the solve plus the "id" of the system; one that could not be read or solved
+    has an "error" instead. With `output_dir` every answer is written there with `write_array`, in `output_format`,
+    as <id>.npy (or <id>.bin for raw values), and the record gives the file.
+    Returns the number of systems and the number of them that failed or did not converge.
+    """
+    out = sys.stdout if out is None else out
+    pending, finished = queue.Queue(depth), queue.Queue(depth)
+    read_failures, write_failures = [], []
+    reader = threading.Thread(target=_read_ahead, args=(systems, pending, read_failures))
+    writer = threading.Thread(target=_write_behind, args=(finished, out, output_format, write_failures))
+    for thread in (reader, writer):
+        thread.daemon = True
+        thread.start()
+    count = failed = 0
+    try:
+        while True:
+            item = pending.get()
+            if item is _END:
+                break
+            system, read_time = item
+            count += 1
+            record = {"id": _to_json(system.id)}
+            answer = None
+            try:
+                if system.error is not None:
+                    raise ValueError(system.error)
+                if np.ndim(system.A) != 2:
+                    raise ValueError("A must be a matrix, not {}-dimensional".format(np.ndim(system.A)))
+                if np.ndim(system.B) not in (1, 2):
+                    raise ValueError("B must be a vector or a matrix, not {}-dimensional".format(np.ndim(system.B)))
+                m, n = np.shape(system.A)
+                if np.shape(system.B)[0] != n:
+                    raise ValueError("A is {} x {} but B has {} rows".format(m, n, np.shape(system.B)[0]))
+                if m != n:
+                    raise ValueError("A must be square, not {} x {}".format(m, n))
+                problem, perm = _screen_system(system.A, solver_type)
+                if problem is not None:
+                    raise ValueError(problem.rstrip(":"))
+                start = time.time()
+                answer, info = matrix_calculator(system.A, system.B, m, n, solver_type, full_output=True, perm=perm,
+                                                 x0=system.x0, **options)[1:]
+                record.update(result_record(solver_type, info, {"read": read_time, "solve": time.time() - start}))
+            except Exception as e: # one system that cannot be solved must not stop the others
+                record["error"] = _error_text(e)
+            if "error" in record or not record["converged"]:
+                failed += 1
+            path = None
+            if output_dir is not None:
+                extension = ".bin" if output_format == "raw" else ".npy"
+                path = os.path.join(output_dir, str(record["id"]).replace("/", "_") + extension)
+            finished.put((record, answer, path))
+    finally:
+        finished.put(_END)
+        writer.join()
+    reader.join()
+    for failures in (write_failures, read_failures):
+        if failures:
+            raise failures[0]
+    return count, failed
+
+def parse_batch_cmdline(argv):
+    """
+    Returns the parsed argument list and return code of `matcalc batch`.
+    `argv` is the list of arguments after "batch".
+    """
+    parser = argparse.ArgumentParser(prog="matcalc batch",
+                                     description="Solves a stream of systems and prints one JSON record per system.")
+    _add_solver_arguments(parser)
+    parser.add_argument("--output-dir", default=None,
+                        help="Write every answer to a file named after its system in this directory instead of putting it in the record.")
+    parser.add_argument("--output-format", choices=("npy", "raw", "memmap"), default=None,
+                        help="The format of the files in --output-dir: npy, raw, or memmap for a .npy file written through a memory map. The default is npy.")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="How many systems may wait to be solved, and how many records to be written, at once. The default is 4.")
+    parser.add_argument("source", nargs="?", default="-",
+                        help="Where to read the systems: a file of NDJSON lines, each an object with A and B as nested lists or matrix text, a .npz archive holding several systems, or a directory of .npz archives. The default, '-', reads NDJSON from standard input.")
+    args = parser.parse_args(argv)
+    if not _precond_omega_ok(args):
+        parser.print_help()
+        return args, 2
+    if args.source != "-" and not os.path.exists(args.source):
+        warning("Could not read the systems:", "{} does not exist".format(args.source))
+        parser.print_help()
+        return args, 2
+    if args.output_dir is not None and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    return args, 0
+
+def batch_main(argv):
+    """
+    Runs `matcalc batch`: solves every system read by `read_systems` with `solve_systems`.
+    """
+    args, ret = parse_batch_cmdline(argv)
+    if ret != 0:
+        return ret
+    count, failed = solve_systems(read_systems(args.source), args.solver, output_dir=args.output_dir,
+                                  output_format=args.output_format, depth=args.depth, scaling=args.scaling,
+                                  **_solver_options(args))
+    if failed:
+        warning("{} of {} systems failed or did not converge".format(failed, count))
+    return 0  # success
+
+
 def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == "batch": # `matcalc batch` solves a stream of systems instead of the one given here
+        return batch_main(argv[1:])
+    start = time.time()
     args, ret = parse_cmdline(argv)
     if ret != 0:
         return ret
+    timings = {"read": time.time() - start}
     #  print(canvas(args.no_attribution))
     m, n = np.shape(args.A)
-    if diagonally_dominant_check(args.A) is False:
-        warning("Matrix must be diagonally dominant:", RuntimeWarning)
+    problem, perm = _screen_system(args.A, args.solver)
+    if problem is not None:
+        warning(problem, RuntimeWarning)
+        if args.json: # a pipeline reading the records still gets one for this system
+            print(json.dumps({"method": _SOLVER_NAMES[args.solver], "converged": False,
+                              "error": problem.rstrip(":"), "timings": timings}))
     else:
-        statement, answer = matrix_calculator(args.A, args.B, m, n, args.solver)
-        print(statement)
-        print(answer)
+        start = time.time()
+        try:
+            statement, answer, info = matrix_calculator(args.A, args.B, m, n, args.solver, full_output=True,
+                                                        perm=perm, scaling=args.scaling, x0=args.x0,
+                                                        **_solver_options(args))
+        except ValueError as e: # such as a preconditioner that cannot be built for this A
+            warning("Could not solve the system:", e)
+            return 2
+        timings["solve"] = time.time() - start
+        if not info["converged"]:
+            warning("The solver stopped without converging ({}) after {} iterations".format(info["reason"],
+                                                                                          info["iterations"]))
+        if args.output is not None:
+            start = time.time()
+            write_array(args.output, answer, args.output_format)
+            timings["write"] = time.time() - start
+        unscaled = None
+        if args.scaling_report and args.scaling != "none":
+            unscaled = matrix_calculator(args.A, args.B, m, n, args.solver, full_output=True, perm=perm, x0=args.x0,
+                                         **_solver_options(args))[2]
+        if args.json: # the report goes into the record, so stdout stays one JSON record per line
+            record = result_record(args.solver, info, timings, answer, args.output)
+            if unscaled is not None:
+                record["scaled_iterations"], record["unscaled_iterations"] = info["iterations"], unscaled["iterations"]
+            print(json.dumps(record))
+        else:
+            print(statement)
+            print(answer if args.output is None else "(written to {})".format(args.output))
+            if unscaled is not None:
+                print("With {} scaling the solve took {} iterations, against {} without it".format(
+                    args.scaling, info["iterations"], unscaled["iterations"]))
     return 0  # success
 
 
@@ -4,8 +4,15 @@ Unit and regression test for the 1_che696_project package.
 """
 
 # Import package, test suite, and other packages as needed
+import os
 import sys
+import json
+import io
+import shutil
+import tempfile
 import unittest
+import argparse
+import tracemalloc
 from contextlib import contextmanager
 from io import StringIO
 import logging
@@ -15,7 +22,17 @@ logger = logging.getLogger(__name__)
 DISABLE_REMOVE = logger.isEnabledFor(logging.DEBUG)
 
 #from matcalc import canvas
-from a_che696_project.matcalc import main, parse_cmdline
+import numpy as np
+import scipy.sparse as sp
+
+from a_che696_project.matcalc import (main, parse_cmdline, residual, jacobi, matrix_calculator,
+                                      diagonally_dominant_check, batch_calculator, conjugate_gradient, gmres,
+                                      bicgstab, make_preconditioner, jacobi_spectral_radius, optimal_omega,
+                                      color_classes, gauss_siedel, diagonal_dominance,
+                                      dominant_permutation, equilibrate, direct_solve, FactorizationCache,
+                                      Solver, jacobi_iterates, gauss_siedel_iterates, parse_matrix, load_array,
+                                      read_matrix_market, write_array,
+                                      BatchSystem, read_systems, solve_systems, positive_int_type)
 
 
 class TestProject(unittest.TestCase):
@@ -30,7 +47,7 @@ class TestProject(unittest.TestCase):
         test_input = ['5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
         parse_cmdline(test_input)
         with capture_stdout(main, test_input) as output:
-            self.assertTrue("[ 0.57749612  0.45105771 -0.32800935]" in output)
+            self.assertTrue("[ 0.57739235  0.45109532 -0.32795924]" in output)
 
     def testNotDiagDomMatrix(self): # Testing to see if the matrix is diagonally dominant
         test_input = ['1,1,1;2,3,5;4,0,5', '1;2;3']
@@ -42,7 +59,15 @@ class TestProject(unittest.TestCase):
         test_input = ["-s", "j", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
         parse_cmdline(test_input)
         with capture_stdout(main, test_input) as output:
-            self.assertTrue("[ 0.57749612  0.45105771 -0.32800935]" in output)
+            self.assertTrue("[ 0.57739235  0.45109532 -0.32795924]" in output)
+
+    def testJacobiUsesOldIterate(self): # A symmetric system stays symmetric only if each sweep uses the old iterate
+        A = np.array([[4., 1.], [1., 4.]])
+        B = np.array([5., 5.])
+        state, answer = jacobi(A, B, 2, 2)
+        self.assertTrue("Jacobi" in state)
+        self.assertEqual(answer[0], answer[1])
+        self.assertTrue(np.allclose(answer, np.linalg.solve(A, B), atol=0.01))
 
     def testGauss(self): # Testing to see if the Gauss method yields the correct answer
         test_input = ["-s", "g", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
@@ -57,6 +82,1014 @@ class TestProject(unittest.TestCase):
             self.assertTrue("[ 0.5776533   0.45030048 -0.32795644]" in output)
 
 
+class TestResidual(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([[1.], [2.], [3.]]) # shaped the way the command line parser stores B
+        self.x = np.array([0.1, 0.2, -0.3])
+
+    def testMatchesLoop(self): # The vectorized residual must give the same value as summing the rows by hand
+        build = 0
+        for i in range(3):
+            temp = self.B[i, 0]
+            for j in range(3):
+                temp = temp - self.A[i, j]*self.x[j]
+            build += temp**2
+        self.assertAlmostEqual(residual(self.A, self.B, self.x, 3, 3), np.sqrt(build))
+
+    def testNorms(self): # Testing the infinity and relative norms against numpy
+        r = self.B.ravel() - self.A.dot(self.x)
+        self.assertAlmostEqual(residual(self.A, self.B, self.x, 3, 3, norm="inf"), np.abs(r).max())
+        self.assertAlmostEqual(residual(self.A, self.B, self.x, 3, 3, norm="rel"),
+                               np.linalg.norm(r)/np.linalg.norm(self.B))
+        with self.assertRaises(ValueError):
+            residual(self.A, self.B, self.x, 3, 3, norm="l1")
+
+    def testWorkBuffer(self): # The residual vector is written into the buffer that is passed in
+        work = np.empty(3)
+        residual(self.A, self.B, self.x, 3, 3, work=work)
+        self.assertTrue(np.allclose(work, self.B.ravel() - self.A.dot(self.x)))
+
+
+class TestSparse(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([[1.], [2.], [3.]])
+
+    def testSolversMatchDense(self): # Every solver must give the same answer for CSR, CSC and dense input
+        for solver in ("j", "g", "s"):
+            dense_state, dense_answer = matrix_calculator(self.A, self.B, 3, 3, solver)
+            for sparse_A in (sp.csr_matrix(self.A), sp.csc_matrix(self.A)):
+                state, answer = matrix_calculator(sparse_A, self.B, 3, 3, solver)
+                self.assertEqual(state, dense_state)
+                self.assertTrue(np.allclose(answer, dense_answer))
+
+    def testSparseResidual(self):
+        x = np.array([0.1, 0.2, -0.3])
+        self.assertAlmostEqual(residual(sp.csr_matrix(self.A), self.B, x, 3, 3), residual(self.A, self.B, x, 3, 3))
+
+    def testSparseDiagDom(self):
+        self.assertTrue(diagonally_dominant_check(sp.csr_matrix(self.A)))
+        self.assertFalse(diagonally_dominant_check(sp.csc_matrix([[1., 1., 1.], [2., 3., 5.], [4., 0., 5.]])))
+
+    def testLargeTridiagonal(self): # A 1-D diffusion-like system that would be far too slow to sweep as a dense matrix
+        n = 2000
+        A = sp.diags([-1., 4., -1.], [-1, 0, 1], shape=(n, n), format="csr")
+        B = np.ones(n)
+        for solver in ("j", "g"):
+            state, answer = matrix_calculator(A, B, n, n, solver)
+            self.assertTrue(residual(A, B, answer, n, n) <= 0.01)
+
+
+class TestMultipleRHS(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([[1., 4., 0.], [2., 5., 0.], [3., 6., 0.]])
+
+    def testBlockMatchesColumns(self): # Solving the block at once must give the same answer as one column at a time
+        for solver in ("j", "g", "s"):
+            state, answer = matrix_calculator(self.A, self.B, 3, 3, solver)
+            self.assertEqual(answer.shape, (3, 3))
+            for k in range(3):
+                state, column = matrix_calculator(self.A, self.B[:, k], 3, 3, solver)
+                self.assertTrue(np.allclose(answer[:, k], column))
+
+    def testBlockResidual(self): # A block guess gives one residual norm per column
+        x = np.zeros((3, 3))
+        norms = residual(self.A, self.B, x, 3, 3)
+        self.assertTrue(np.allclose(norms, np.linalg.norm(self.B, axis=0)))
+
+    def testSparseBlock(self):
+        state, answer = matrix_calculator(sp.csr_matrix(self.A), self.B, 3, 3, "g")
+        self.assertTrue(np.all(residual(self.A, self.B, answer, 3, 3) <= 0.01))
+
+    def testCommandLineBlock(self):
+        test_input = ["-s", "g", '5,-2,3;-3,9,1;2,-1,-7', '1,1;2,2;3,3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("[[ 0.57749612  0.57749612]" in output)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.A = rng.uniform(-1, 1, (20, 5, 5))
+        self.A += np.eye(5)*(np.abs(self.A).sum(axis=2, keepdims=True) + 1) # make every system diagonally dominant
+        self.B = rng.uniform(-1, 1, (20, 5))
+
+    def testMatchesSingleSolves(self): # The stacked solve must give the same answers as solving each system alone
+        for solver in ("j", "g"):
+            state, answer, iterations = batch_calculator(self.A, self.B, solver)
+            self.assertEqual(answer.shape, (20, 5))
+            for s in range(20):
+                single_state, single = matrix_calculator(self.A[s], self.B[s], 5, 5, solver)
+                self.assertTrue(np.allclose(answer[s], single))
+
+    def testIterationCounts(self): # Each system reports its own iteration count, and a zero B needs none
+        B = self.B.copy()
+        B[3] = 0
+        state, answer, iterations = batch_calculator(self.A, B, "g")
+        self.assertEqual(iterations[3], 0)
+        self.assertTrue(np.all(iterations[np.arange(20) != 3] > 0))
+
+    def testProjectSystem(self):
+        A = np.array([[[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]]]*2)
+        B = np.array([[1., 2., 3.]]*2)
+        state, answer, iterations = batch_calculator(A, B, "g")
+        self.assertTrue("Gauss" in state)
+        self.assertTrue(np.allclose(answer, [0.57749612, 0.45105771, -0.32800935]))
+        state, answer, iterations = batch_calculator(A, B, "s")
+        self.assertTrue(np.allclose(answer, [0.5776533, 0.45030048, -0.32795644]))
+
+
+class TestConjugateGradient(unittest.TestCase):
+
+    def testDiffusion(self): # A 2-D diffusion matrix, which is SPD but only weakly diagonally dominant
+        n = 30
+        T = sp.diags([-1., 2., -1.], [-1, 0, 1], shape=(n, n))
+        A = sp.kronsum(T, T, format="csr")
+        B = np.ones(n*n)
+        state, answer = conjugate_gradient(A, B, n*n, n*n)
+        self.assertTrue("Conjugate Gradient" in state)
+        self.assertTrue(residual(A, B, answer, n*n, n*n) <= 0.01)
+        state, dense_answer = matrix_calculator(A.toarray(), B, n*n, n*n, "c")
+        self.assertTrue(np.allclose(answer, dense_answer))
+
+    def testBlock(self):
+        A = np.array([[4., 1., 0.], [1., 3., 1.], [0., 1., 2.]])
+        B = np.array([[1., 0.], [2., 0.], [3., 1.]])
+        state, answer = conjugate_gradient(A, B, 3, 3)
+        self.assertTrue(np.all(residual(A, B, answer, 3, 3) <= 0.01))
+
+    def testCommandLine(self):
+        test_input = ["-s", "c", '4,1,0;1,3,1;0,1,2', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("Conjugate Gradient" in output)
+        test_input = ["-s", "c", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stderr(main, test_input) as output:
+            self.assertTrue("symmetric" in output)
+
+
+class TestKrylov(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([[1.], [2.], [3.]])
+
+    def testProjectSystem(self): # Both methods must solve the nonsymmetric project matrix
+        for solver in (gmres, bicgstab):
+            state, answer = solver(self.A, self.B, 3, 3)
+            self.assertEqual(answer.shape, (3,))
+            self.assertTrue(residual(self.A, self.B, answer, 3, 3) <= 0.01)
+
+    def testWeakDominance(self): # A nonsymmetric convection-diffusion matrix that is not diagonally dominant
+        n = 200
+        A = sp.diags([-1.5, 2., -0.4], [-1, 0, 1], shape=(n, n), format="csr")
+        B = np.ones((n, 2))
+        B[:, 1] = np.arange(n)/n
+        for state, answer in (gmres(A, B, n, n, restart=10), bicgstab(A, B, n, n),
+                              matrix_calculator(A, B, n, n, "m", restart=30)):
+            self.assertTrue(np.all(residual(A, B, answer, n, n) <= 0.01))
+
+    def testCommandLine(self): # The Krylov methods do not need the diagonally dominant matrix that Jacobi rejects
+        for solver, name in (("m", "GMRES"), ("b", "BiCGSTAB")):
+            test_input = ["-s", solver, "-r", "2", '1,1,1;2,3,5;4,0,5', '1;2;3']
+            with capture_stdout(main, test_input) as output:
+                self.assertTrue(name in output)
+
+
+class TestPreconditioners(unittest.TestCase):
+
+    def setUp(self):
+        n = 20
+        T = sp.diags([-1., 2.5, -1.2], [-1, 0, 1], shape=(n, n))
+        self.A = sp.kronsum(T, T, format="csr") # a nonsymmetric 2-D stencil matrix
+        self.B = np.ones(n*n)
+
+    def testILUTridiagonal(self): # ILU(0) of a tridiagonal matrix has no dropped fill, so it is the exact inverse
+        A = sp.diags([-1., 4., -2.], [-1, 0, 1], shape=(50, 50), format="csr")
+        M = make_preconditioner(A, "ilu")
+        b = np.arange(50.)
+        self.assertTrue(np.allclose(M.apply(b, np.empty(50)), np.linalg.solve(A.toarray(), b)))
+
+    def testILUPattern(self): # On a 2-D stencil ILU(0) is not exact, but L*U matches A on its own sparsity pattern
+        M = make_preconditioner(self.A, "ilu")
+        product = np.linalg.inv(np.array([M.apply(e, np.empty(400)) for e in np.eye(400)]).T)
+        pattern = self.A.toarray() != 0
+        self.assertTrue(np.allclose(product[pattern], self.A.toarray()[pattern]))
+
+    def testSSOR(self): # Applying SSOR must match building M explicitly
+        A = self.A.toarray()
+        w = 1.3
+        D = np.diag(np.diag(A))
+        M = w/(2 - w)*np.dot(np.dot(D/w + np.tril(A, -1), np.linalg.inv(D/w)), D/w + np.triu(A, 1))
+        b = np.arange(400.)
+        for matrix in (A, self.A):
+            precond = make_preconditioner(matrix, "ssor", w)
+            self.assertTrue(np.allclose(precond.apply(b, np.empty(400)), np.linalg.solve(M, b)))
+        with self.assertRaises(ValueError):
+            make_preconditioner(A, "ssor", 2.5)
+
+    def testSolvers(self): # Every Krylov solver must converge with every preconditioner, dense and sparse
+        for kind in ("none", "jacobi", "ssor", "ilu"):
+            for solver in ("m", "b"):
+                for A in (self.A, self.A.toarray()):
+                    state, answer = matrix_calculator(A, self.B, 400, 400, solver, preconditioner=kind)
+                    self.assertTrue(residual(A, self.B, answer, 400, 400) <= 0.01)
+        A = self.A + self.A.T # symmetric, for conjugate gradient
+        for kind in ("none", "jacobi", "ssor"):
+            state, answer = matrix_calculator(A, np.ones((400, 2)), 400, 400, "c", preconditioner=kind)
+            self.assertTrue(np.all(residual(A, np.ones((400, 2)), answer, 400, 400) <= 0.01))
+
+    def testCommandLine(self):
+        test_input = ["-s", "b", "-p", "ilu", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("[ 0.57728707  0.4511041  -0.32807571]" in output) # dense ILU(0) is exact LU
+        test_input = ["-s", "m", "-p", "ssor", "--precond-omega", "2.5", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stderr(main, test_input) as output:
+            self.assertTrue("between 0 and 2" in output)
+        self.assertEqual(main(test_input), 2)
+
+    def testUnbuildable(self): # ILU(0) of a sparse A with a missing diagonal entry is reported, not raised
+        tmp_dir = tempfile.mkdtemp()
+        if not DISABLE_REMOVE:
+            self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "A.npz")
+        sp.save_npz(path, sp.csr_matrix(np.array([[0., 1., 0.], [1., 4., 1.], [0., 1., 4.]])))
+        test_input = ["-s", "m", "-p", "ilu", "--A-file", path, '1;2;3']
+        with capture_stderr(main, test_input) as output:
+            self.assertTrue("Could not solve the system" in output)
+        self.assertEqual(main(test_input), 2)
+
+
+class TestOmega(unittest.TestCase):
+
+    def testSpectralRadius(self): # For the 1-D Poisson matrix the Jacobi spectral radius is cos(pi/(n+1))
+        n = 20
+        A = sp.diags([-1., 2., -1.], [-1, 0, 1], shape=(n, n), format="csr")
+        rho = np.cos(np.pi/(n + 1))
+        self.assertAlmostEqual(jacobi_spectral_radius(A, iterations=200), rho, places=3)
+        self.assertAlmostEqual(optimal_omega(A.toarray()), 2/(1 + np.sqrt(1 - rho**2)), places=1)
+
+    def testNotConvergent(self): # Without a convergent Jacobi iteration the formula does not apply
+        self.assertEqual(optimal_omega(np.array([[1., 3.], [3., 1.]])), 1.0)
+
+    def testAutoSolve(self):
+        n = 20
+        A = sp.diags([-1., 2., -1.], [-1, 0, 1], shape=(n, n), format="csr")
+        state, answer = matrix_calculator(A, np.ones(n), n, n, "s", w="auto")
+        self.assertTrue("w = 1.7" in state)
+        self.assertTrue(residual(A, np.ones(n), answer, n, n) <= 0.01)
+
+    def testCommandLine(self):
+        test_input = ["-s", "s", "-w", "auto", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("w = 1.0161" in output)
+        test_input = ["-s", "s", "-w", "1", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("[ 0.57749612  0.45105771 -0.32800935]" in output)
+
+
+class TestMulticolor(unittest.TestCase):
+
+    def setUp(self):
+        n = 15
+        T = sp.diags([-1., 4., -1.], [-1, 0, 1], shape=(n, n))
+        self.A = sp.kronsum(T, T, format="csr") # 5-point stencil
+        self.n = n*n
+
+    def testRedBlack(self): # A 5-point stencil needs exactly two colors, and no color is coupled to itself
+        classes = color_classes(self.A)
+        self.assertEqual(len(classes), 2)
+        self.assertEqual(sum(len(c) for c in classes), self.n)
+        for c in classes:
+            block = self.A[c][:, c].toarray()
+            self.assertTrue(np.all(block == np.diag(np.diag(block))))
+
+    def testGreedy(self): # The project matrix couples every unknown to every other one, so each gets its own color
+        classes = color_classes(np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]]))
+        self.assertEqual(sorted(len(c) for c in classes), [1, 1, 1])
+
+    def testSolve(self):
+        B = np.ones((self.n, 2))
+        for solver in ("g", "s"):
+            for A in (self.A, self.A.toarray()):
+                state, answer = matrix_calculator(A, B, self.n, self.n, solver, w=1.2, ordering="multicolor")
+                self.assertTrue(np.all(residual(A, B, answer, self.n, self.n) <= 0.01))
+
+    def testCommandLine(self):
+        test_input = ["-s", "g", "-o", "multicolor", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("[ 0.57749612  0.45105771 -0.32800935]" in output)
+
+
+class TestStopping(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([1., 2., 3.])
+
+    def testConverged(self):
+        for solver in ("j", "g", "s", "m", "b"):
+            state, answer, info = matrix_calculator(self.A, self.B, 3, 3, solver, full_output=True)
+            self.assertTrue(info["converged"])
+            self.assertEqual(info["reason"], "converged")
+            self.assertTrue(info["iterations"] > 0)
+            self.assertAlmostEqual(info["residual"], residual(self.A, self.B, answer, 3, 3))
+
+    def testMaxIter(self):
+        for solver in ("j", "g", "c", "m", "b"):
+            state, answer, info = matrix_calculator(self.A + self.A.T, self.B, 3, 3, solver, max_iter=1,
+                                                    full_output=True)
+            self.assertEqual(info["reason"], "max_iter")
+            self.assertEqual(info["iterations"], 1)
+            self.assertTrue("stopped early (max_iter)" in state)
+
+    def testTimeLimit(self):
+        state, answer, info = jacobi(self.A, self.B, 3, 3, time_limit=0, full_output=True)
+        self.assertEqual(info["reason"], "time_limit")
+
+    def testDiverged(self): # Jacobi on a matrix that is far from diagonally dominant blows up
+        state, answer, info = jacobi(np.array([[1., 3.], [3., 1.]]), np.array([1., 2.]), 2, 2, full_output=True)
+        self.assertFalse(info["converged"])
+        self.assertEqual(info["reason"], "diverged")
+
+    def testStagnated(self): # A singular, inconsistent system whose residual can never drop
+        state, answer, info = gauss_siedel(np.array([[1., 1.], [1., 1.]]), np.array([1., 2.]), 2, 2, 1.0,
+                                           full_output=True)
+        self.assertEqual(info["reason"], "stagnated")
+
+    def testBatch(self): # Only the divergent system of a stack is stopped; the other still converges
+        A = np.array([[[1., 3.], [3., 1.]], [[3., 1.], [1., 3.]]])
+        B = np.array([[1., 2.], [1., 2.]])
+        state, answer, iterations, info = batch_calculator(A, B, "j", full_output=True)
+        self.assertEqual(list(info["converged"]), [False, True])
+        self.assertTrue(np.allclose(answer[1], np.linalg.solve(A[1], B[1]), atol=0.01))
+        state, answer, iterations = batch_calculator(A, B, "j", max_iter=3)
+        self.assertEqual(list(iterations), [3, 3])
+
+    def testCommandLine(self):
+        test_input = ["--max-iter", "2", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stderr(main, test_input) as output:
+            self.assertTrue("max_iter" in output)
+
+
+class TestTolerance(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([1., 2., 3.])
+
+    def testTolerances(self): # A tighter tolerance must give a smaller residual, for every solver
+        for solver in ("j", "g", "s", "m", "b"):
+            state, answer = matrix_calculator(self.A, self.B, 3, 3, solver, atol=1e-10)
+            self.assertTrue(residual(self.A, self.B, answer, 3, 3) <= 1e-10)
+            state, answer = matrix_calculator(self.A, 1e6*self.B, 3, 3, solver, atol=0, rtol=1e-8)
+            self.assertTrue(residual(self.A, 1e6*self.B, answer, 3, 3, norm="rel") <= 1e-8)
+
+    def testBatchTolerance(self):
+        state, answer, iterations = batch_calculator(self.A[np.newaxis], self.B[np.newaxis], "g", atol=1e-12)
+        self.assertTrue(np.allclose(answer[0], np.linalg.solve(self.A, self.B), atol=1e-12))
+
+    def testCheckEvery(self): # Checking every 4 sweeps rounds the iteration count up to a multiple of 4
+        state, answer, info = matrix_calculator(self.A, self.B, 3, 3, "g", atol=1e-8, check_every=4,
+                                                full_output=True)
+        self.assertEqual(info["iterations"] % 4, 0)
+        self.assertTrue(info["residual"] <= 1e-8)
+        for check_every in (0, -1): # no sweeps between checks would never stop
+            with self.assertRaises(ValueError):
+                gauss_siedel(self.A, self.B, 3, 3, 1.0, check_every=check_every)
+            with self.assertRaises(ValueError):
+                next(gauss_siedel_iterates(self.A, self.B, 3, 3, 1.6, check_every=check_every))
+            with self.assertRaises(argparse.ArgumentTypeError):
+                positive_int_type(str(check_every))
+
+    def testUpdateCriterion(self): # The update norm stops the solve without a separate residual, and the record
+        for solver in ("j", "g"):   # still reports the true residual
+            state, answer, info = matrix_calculator(self.A, self.B, 3, 3, solver, atol=1e-8, criterion="update",
+                                                    full_output=True)
+            self.assertTrue(info["converged"])
+            self.assertAlmostEqual(info["residual"], residual(self.A, self.B, answer, 3, 3))
+            self.assertTrue(np.allclose(answer, np.linalg.solve(self.A, self.B), atol=1e-7))
+        with self.assertRaises(ValueError):
+            jacobi(self.A, self.B, 3, 3, criterion="energy")
+
+    def testCommandLine(self):
+        test_input = ["-s", "g", "--atol", "1e-12", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("[ 0.57728707  0.4511041  -0.32807571]" in output)
+
+
+class TestIncremental(unittest.TestCase):
+
+    def testMatchesRecomputed(self): # Keeping the residual up to date must not change the iterates
+        n = 12
+        T = sp.diags([-1., 4., -1.], [-1, 0, 1], shape=(n, n))
+        A = sp.kronsum(T, T, format="csr")
+        B = np.ones((n*n, 2))
+        B[:, 1] = np.arange(n*n)
+        for matrix in (A, A.toarray()):
+            for ordering in ("natural", "multicolor"):
+                for b in (B, B[:, 0]):
+                    state, answer, info = matrix_calculator(matrix, b, n*n, n*n, "s", w=1.3, ordering=ordering,
+                                                            atol=1e-6, full_output=True)
+                    state, inc_answer, inc_info = matrix_calculator(matrix, b, n*n, n*n, "s", w=1.3,
+                                                                    ordering=ordering, atol=1e-6, incremental=True,
+                                                                    full_output=True)
+                    self.assertTrue(np.allclose(answer, inc_answer))
+                    self.assertEqual(info["iterations"], inc_info["iterations"])
+                    self.assertTrue(np.allclose(inc_info["residual"], residual(A, b, inc_answer, n*n, n*n)))
+
+    def testCommandLine(self):
+        test_input = ["-s", "g", "--incremental", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("[ 0.57749612  0.45105771 -0.32800935]" in output)
+
+
+class TestDominance(unittest.TestCase):
+
+    def testRowSums(self): # Off-diagonal entries are summed per row, not compared one at a time
+        A = np.array([[3., 2., 2.], [1., 4., 1.], [0., 1., 5.]])
+        for matrix in (A, sp.csr_matrix(A)):
+            report = diagonal_dominance(matrix)
+            self.assertFalse(report.dominant)
+            self.assertEqual(list(report.rows), [0])
+            self.assertTrue(np.allclose(report.margin, [-1., 2., 4.]))
+
+    def testStrictAndWeak(self):
+        A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.assertTrue(diagonal_dominance(A).dominant)
+        report = diagonal_dominance(sp.csr_matrix(A), strict=True)
+        self.assertFalse(report.dominant)
+        self.assertEqual(list(report.rows), [0])
+        self.assertFalse(diagonal_dominance(np.ones((2, 2))).dominant) # every row ties, none strictly dominant
+
+    def testCommandLine(self):
+        test_input = ['3,2,2;1,4,1;0,1,5', '1;2;3']
+        with capture_stderr(main, test_input) as output:
+            self.assertTrue("failing rows: [0]" in output)
+        with capture_stderr(main, ['1,1;1,1', '1;2']) as output:
+            self.assertTrue("no row is strictly dominant" in output)
+
+
+class TestPermutation(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([1., 2., 3.])
+        self.order = [2, 0, 1] # puts no dominant entry on the diagonal
+
+    def testFindsDominantOrder(self):
+        shuffled = self.A[self.order]
+        for matrix in (shuffled, sp.csr_matrix(shuffled)):
+            perm = dominant_permutation(matrix)
+            self.assertTrue(np.array_equal(shuffled[perm], self.A))
+            self.assertTrue(diagonal_dominance(matrix, perm=perm).dominant)
+
+    def testSolversUsePermutation(self): # iterating on A[perm] reproduces the iterates on the unshuffled system
+        shuffled, b = self.A[self.order], self.B[self.order]
+        for matrix in (shuffled, sp.csr_matrix(shuffled)):
+            for kwargs in (dict(solver_type="j"), dict(solver_type="s", w=1.3),
+                           dict(solver_type="g", incremental=True),
+                           dict(solver_type="s", w="auto", ordering="multicolor")):
+                expected = matrix_calculator(self.A, self.B, 3, 3, **kwargs)[1]
+                answer = matrix_calculator(matrix, b, 3, 3, perm="auto", **kwargs)[1]
+                self.assertTrue(np.allclose(answer, expected))
+
+    def testStructurallySingular(self):
+        with self.assertRaises(ValueError):
+            dominant_permutation(np.array([[1., 2.], [0., 0.]]))
+
+    def testNotSquare(self):
+        with self.assertRaises(ValueError):
+            dominant_permutation(np.array([[1., 2., 3.], [4., 5., 6.]]))
+        with capture_stderr(main, ['1,2,3;4,5,6', '1;2;3']) as output:
+            self.assertTrue("Matrix must be square" in output)
+
+    def testCommandLine(self):
+        test_input = ['2,-1,-7;5,-2,3;-3,9,1', '3;1;2']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("[ 0.57739235  0.45109532 -0.32795924]" in output)
+
+
+class TestScaling(unittest.TestCase):
+
+    def setUp(self): # a tridiagonal matrix whose rows span six orders of magnitude
+        n = 30
+        T = sp.diags([-1., 2.05, -1.], [-1, 0, 1], shape=(n, n)).toarray()
+        self.A = 10.0**np.linspace(-3, 3, n)[:, np.newaxis]*T
+        self.B = self.A.dot(np.ones(n))
+        self.n = n
+
+    def testBalancesRowsAndColumns(self):
+        for matrix in (self.A, sp.csr_matrix(self.A)):
+            r, c = equilibrate(matrix)
+            S = np.abs(r[:, np.newaxis]*self.A*c)
+            self.assertTrue(np.allclose(S.max(axis=1), 1, atol=1e-3))
+            self.assertTrue(np.allclose(S.max(axis=0), 1, atol=1e-3))
+            r, c = equilibrate(matrix, "row")
+            self.assertTrue(np.allclose(np.abs(r[:, np.newaxis]*self.A).max(axis=1), 1))
+            self.assertTrue(np.all(c == 1))
+
+    def testUnscalesAnswer(self):
+        for matrix in (self.A, sp.csr_matrix(self.A)):
+            for scaling in ("row", "ruiz"):
+                state, answer, info = matrix_calculator(matrix, self.B, self.n, self.n, "m", atol=0, rtol=1e-8,
+                                                        scaling=scaling, full_output=True)
+                self.assertTrue(np.allclose(answer, 1))
+                self.assertTrue(np.isclose(info["residual"], residual(self.A, self.B, answer, self.n, self.n)))
+
+    def testSymmetricForCG(self): # row scaling alone would make A nonsymmetric and stall conjugate gradient
+        A = np.array([[4., 1., 0.], [1., 300., 2.], [0., 2., 5000.]])
+        for scaling in ("row", "ruiz"):
+            state, answer, info = matrix_calculator(A, self.B[:3], 3, 3, "c", atol=1e-10, scaling=scaling,
+                                                    full_output=True)
+            self.assertTrue(info["converged"])
+            self.assertTrue(np.allclose(answer, np.linalg.solve(A, self.B[:3])))
+
+    def testConvergedOnOriginal(self):
+        A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        state, answer, info = matrix_calculator(A, np.array([1., 2., 3.]), 3, 3, "j", scaling="row", full_output=True)
+        self.assertTrue(info["scaled_residual"] <= 0.01 < info["residual"])
+        self.assertEqual((info["converged"], info["reason"]), (False, "scaled_only"))
+
+    def testCommandLine(self):
+        test_input = ["--scaling", "ruiz", "--scaling-report", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("With ruiz scaling the solve took" in output)
+
+
+class TestDirect(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.S = np.array([[4., -1., 0.], [-1., 4., -1.], [0., -1., 4.]])
+        self.B = np.array([1., 2., 3.])
+
+    def testFactorizations(self):
+        cache = FactorizationCache()
+        for matrix, kind in ((self.A, "lu"), (self.S, "cholesky"), (sp.csc_matrix(self.A), "lu")):
+            state, answer, info = direct_solve(matrix, self.B, 3, 3, full_output=True, cache=cache)
+            self.assertEqual(info["factorization"], kind)
+            self.assertTrue(np.allclose(answer, np.linalg.solve(np.asarray(sp.csr_matrix(matrix).todense()), self.B)))
+        self.assertTrue("[ 0.57728707  0.4511041  -0.32807571]" in str(direct_solve(self.A, self.B, 3, 3)[1]))
+
+    def testNearlySymmetric(self):
+        # Cholesky only reads one triangle, so a matrix that is not exactly symmetric must be factored with LU
+        A = 1e6*np.array([[4., 1.], [1. + 1e-7, 3.]])
+        state, answer, info = direct_solve(A, np.ones(2), 2, 2, full_output=True, cache=FactorizationCache())
+        self.assertEqual(info["factorization"], "lu")
+        self.assertTrue(info["residual"] < 1e-10)
+
+    def testSingular(self):
+        for matrix in (np.array([[1., 2.], [2., 4.]]), sp.csr_matrix(np.array([[1., 2.], [2., 4.]]))):
+            state, answer, info = direct_solve(matrix, np.ones(2), 2, 2, full_output=True, cache=FactorizationCache())
+            self.assertEqual((info["converged"], info["reason"]), (False, "singular"))
+            self.assertTrue(np.all(np.isnan(answer)))
+
+    def testCacheByContent(self):
+        cache = FactorizationCache()
+        direct_solve(self.A, self.B, 3, 3, cache=cache)
+        state, answer, info = direct_solve(self.A.copy(), np.eye(3), 3, 3, full_output=True, cache=cache)
+        self.assertTrue(info["cached"])
+        self.assertTrue(np.allclose(answer, np.linalg.inv(self.A)))
+        direct_solve(sp.csr_matrix(self.A), self.B, 3, 3, cache=cache)
+        direct_solve(sp.csc_matrix(self.A), self.B, 3, 3, cache=cache) # same contents in another format
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 2, 2))
+
+    def testEviction(self):
+        cache = FactorizationCache(max_bytes=200) # room for two dense 3 x 3 factorizations, not three
+        direct_solve(self.A, self.B, 3, 3, cache=cache)
+        direct_solve(self.S, self.B, 3, 3, cache=cache)
+        direct_solve(2*self.A, self.B, 3, 3, cache=cache)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.nbytes <= 200)
+        self.assertFalse(direct_solve(self.A, self.B, 3, 3, full_output=True, cache=cache)[2]["cached"])
+
+    def testCommandLine(self):
+        test_input = ["-s", "d", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("Using the LU factorization" in output)
+            self.assertTrue("[ 0.57728707  0.4511041  -0.32807571]" in output)
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def setUp(self):
+        n = 12
+        T = sp.diags([-1., 2.2, -1.], [-1, 0, 1], shape=(n, n))
+        self.A = sp.kronsum(T, T, format="csr")
+        self.B = np.sin(0.01*np.arange(n*n))
+        self.n = n*n
+
+    def testWrongLength(self):
+        for x0 in (np.zeros(self.n + 1), np.zeros(self.n - 1), 0.):
+            for scaling in (None, "ruiz"):
+                with self.assertRaises(ValueError):
+                    matrix_calculator(self.A, self.B, self.n, self.n, "j", x0=x0, scaling=scaling)
+
+    def testInitialGuess(self): # starting from the answer, every solver is done before its first iteration
+        exact = direct_solve(self.A, self.B, self.n, self.n)[1]
+        for solver_type in ("j", "g", "s", "c", "m", "b"):
+            blocks = (np.column_stack([self.B, 2*self.B]), np.column_stack([exact, 2*exact]))
+            for b, guess in ((self.B, exact), blocks):
+                state, answer, info = matrix_calculator(self.A, b, self.n, self.n, solver_type, atol=1e-6, x0=guess,
+                                                        full_output=True)
+                self.assertEqual(info["iterations"], 0)
+                self.assertTrue(np.allclose(answer, guess))
+
+    def testSolverWarmStarts(self):
+        for solver_type in ("j", "s", "c"):
+            solver = Solver(self.A, solver_type, atol=0, rtol=1e-4)
+            solver.solve(self.B)
+            cold = solver.info["iterations"]
+            solver.solve(self.B*(1 + 1e-4))
+            self.assertTrue(solver.info["iterations"] < cold/5)
+            self.assertTrue(residual(self.A, self.B*(1 + 1e-4), solver.x, self.n, self.n, "rel") <= 1e-4)
+            solver.reset()
+            solver.solve(self.B)
+            self.assertEqual(solver.info["iterations"], cold)
+
+    def testCommandLine(self):
+        tmp_dir = tempfile.mkdtemp()
+        if not DISABLE_REMOVE:
+            self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "x0.txt")
+        np.savetxt(path, [0.57728707, 0.4511041, -0.32807571])
+        test_input = ["--x0", path, '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            self.assertTrue("[ 0.57728707  0.4511041  -0.32807571]" in output)
+        np.savetxt(path, [1., 2.])
+        with capture_stderr(main, ["--x0", path, '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']) as output:
+            self.assertTrue("Could not read the initial guess" in output)
+
+
+class TestSolver(unittest.TestCase):
+
+    def setUp(self):
+        n = 10
+        T = sp.diags([-1., 2.2, -1.], [-1, 0, 1], shape=(n, n))
+        self.A = sp.kronsum(T, T, format="csr")
+        self.B = np.sin(0.01*np.arange(n*n))
+        self.n = n*n
+
+    def testMatchesMatrixCalculator(self):
+        for matrix in (self.A, self.A.toarray()):
+            for solver_type, w in (("j", None), ("g", None), ("s", 1.3), ("s", "auto")):
+                for b in (self.B, np.column_stack([self.B, -self.B])):
+                    state, answer, info = matrix_calculator(matrix, b, self.n, self.n, solver_type, w=w, atol=1e-8,
+                                                            full_output=True)
+                    solver = Solver(matrix, solver_type, w=w, atol=1e-8)
+                    x = solver.solve(b)
+                    self.assertEqual(solver.message, state)
+                    self.assertEqual(solver.info["iterations"], info["iterations"])
+                    self.assertTrue(np.allclose(x, answer, atol=1e-12))
+
+    def testReusesWorkspace(self):
+        solver = Solver(self.A, "s", atol=1e-8)
+        first = solver.solve(self.B)
+        self.assertTrue(np.shares_memory(solver.solve(2*self.B), first))
+        self.assertTrue(np.allclose(solver.x, direct_solve(self.A, 2*self.B, self.n, self.n)[1], atol=1e-6))
+        self.assertTrue(solver.dominance.dominant)
+
+    def testOtherOptions(self): # anything the Solver has no loop of its own for goes through matrix_calculator
+        for solver_type, options in (("s", dict(ordering="multicolor")), ("m", dict(preconditioner="ilu"))):
+            solver = Solver(self.A, solver_type, atol=1e-8, **options)
+            state, answer, info = matrix_calculator(self.A, self.B, self.n, self.n, solver_type, atol=1e-8,
+                                                    full_output=True, **options)
+            self.assertTrue(np.allclose(solver.solve(self.B), answer))
+            self.assertEqual(solver.solve(self.B).shape, (self.n,))
+            self.assertEqual(solver.info["iterations"], 0)
+
+    def testNotSquare(self):
+        with self.assertRaises(ValueError):
+            Solver(np.ones((2, 3)))
+
+    def testNoAllocation(self):
+        # A dense solve with many right-hand sides works in the Solver's own buffers; numpy's broadcasting buffer
+        # (at most 64 KiB) and the residual history are all it may allocate, less than one n x k block
+        n, k = 500, 40
+        A = np.random.RandomState(0).rand(n, n)
+        A += np.diag(2*A.sum(axis=1))
+        B = np.random.RandomState(1).rand(n, k)
+        for solver_type in ("j", "g", "s"):
+            solver = Solver(A, solver_type, atol=1e-8)
+            solver.solve(B)
+            B_next = B + 1e-3
+            tracemalloc.start()
+            try:
+                solver.solve(B_next)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertTrue(solver.info["converged"])
+            self.assertTrue(peak < B.nbytes, "{} allocated {} bytes".format(solver_type, peak))
+
+
+class TestIterates(unittest.TestCase):
+
+    def setUp(self):
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([1., 2., 3.])
+
+    def testSameIterationAsSolvers(self):
+        for iterates, solver_type in ((jacobi_iterates(self.A, self.B, 3, 3), "j"),
+                                      (gauss_siedel_iterates(self.A, self.B, 3, 3, 1.6), "s")):
+            state, answer, info = matrix_calculator(self.A, self.B, 3, 3, solver_type, full_output=True)
+            history = []
+            for iteration, x, res in iterates:
+                history.append(res)
+                if res <= 0.01:
+                    break
+            self.assertEqual(iteration, info["iterations"])
+            self.assertTrue(np.allclose(x, answer))
+            self.assertTrue(np.allclose(history, info["history"]))
+
+    def testNoCopies(self): # the iterate handed out is the solver's own buffer, shaped like B
+        iterates = gauss_siedel_iterates(self.A, self.B.reshape(3, 1), 3, 3, 1.0, incremental=True)
+        iteration, x, res = next(iterates)
+        self.assertEqual((iteration, x.shape), (0, (3,)))
+        first = x.copy()
+        next(iterates)
+        self.assertFalse(np.allclose(x, first)) # updated in place by the sweep
+        block = jacobi_iterates(self.A, np.column_stack([self.B, 2*self.B]), 3, 3)
+        for iteration, x, res in block:
+            if iteration == 5:
+                break
+        self.assertEqual((x.shape, res.shape), ((3, 2), (2,)))
+        self.assertTrue(np.allclose(x[:, 1], 2*x[:, 0]))
+
+
+class TestParser(unittest.TestCase):
+
+    def testFormats(self):
+        A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        for text in ('5,-2,3;-3,9,1;2,-1,-7', ' 5, -2 ,3 ; -3,9,1;2,-1,-7;', '5 -2 3\n-3\t9 1\r\n2 -1 -7\n',
+                     '5e0,-2.0,0.3E+1;-3,9,1;2,-1,-7'):
+            self.assertTrue(np.array_equal(parse_matrix(text), A))
+        self.assertEqual(parse_matrix('1;2;3').shape, (3, 1))
+        self.assertEqual(parse_matrix('1,2,3').shape, (1, 3))
+
+    def testInvalid(self):
+        for text in ('1,2;3', '1,,2;3,4,5', '1,2;x,3', '', '1;;2', '1,2;3,4x', '1,2;3,4e'):
+            with self.assertRaises(ValueError):
+                parse_matrix(text)
+        with self.assertRaises(ValueError) as context:
+            parse_matrix('1x,2;3,4')
+        self.assertTrue("entry 1" in str(context.exception) and "'1x'" in str(context.exception))
+        with capture_stderr(main, ['5,-2,3;-3,9;2,-1,-7', '1;2;3']) as output:
+            self.assertTrue("Row 2 has 2 entries but row 1 has 3" in output)
+
+    def testStdin(self):
+        stdin, sys.stdin = sys.stdin, StringIO("5 -2 3\n-3 9 1\n2 -1 -7\n")
+        try:
+            with capture_stdout(main, ['-', '1;2;3']) as output:
+                self.assertTrue("[ 0.57739235  0.45109532 -0.32795924]" in output)
+        finally:
+            sys.stdin = stdin
+
+
+class TestMatrixFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        if not DISABLE_REMOVE:
+            self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([1., 2., 3.])
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def testFormats(self):
+        np.save(self.path("A.npy"), self.A)
+        np.savez(self.path("AB.npz"), A=self.A, B=self.B)
+        sp.save_npz(self.path("sparse.npz"), sp.csc_matrix(self.A))
+        self.A.astype("<f8").tofile(self.path("A.bin"))
+        mapped = load_array(self.path("A.npy"))
+        self.assertTrue(isinstance(mapped, np.memmap)) # read lazily from disk, not copied
+        self.assertTrue(np.shares_memory(np.asarray(mapped, dtype=float), mapped))
+        self.assertTrue(np.array_equal(load_array(self.path("AB.npz"), "B"), self.B))
+        self.assertTrue(sp.isspmatrix_csr(load_array(self.path("sparse.npz"))))
+        self.assertTrue(np.array_equal(load_array(self.path("A.bin"), shape=(3, 3)), self.A))
+        with self.assertRaises(ValueError):
+            load_array(self.path("AB.npz")) # two arrays, and no name to pick one
+
+    def testCommandLine(self):
+        np.save(self.path("A.npy"), self.A)
+        sp.save_npz(self.path("sparse.npz"), sp.csr_matrix(self.A))
+        self.A.astype("<f8").tofile(self.path("A.bin"))
+        self.B.astype("<f8").tofile(self.path("B.bin"))
+        for test_input in (["--A-file", self.path("A.npy"), '1;2;3'], ["--A-file", self.path("sparse.npz"), '1;2;3'],
+                           ["--A-file", self.path("A.bin"), "--B-file", self.path("B.bin")],
+                           ["--B-file", self.path("B.bin"), '5,-2,3;-3,9,1;2,-1,-7']):
+            with capture_stdout(main, test_input) as output:
+                self.assertTrue("[ 0.57739235  0.45109532 -0.32795924]" in output)
+        self.B[:2].astype("<f8").tofile(self.path("B.bin"))
+        with capture_stderr(main, ["--A-file", self.path("A.bin"), "--B-file", self.path("B.bin")]) as output:
+            self.assertTrue("identical" in output)
+        with capture_stderr(main, ["--A-file", self.path("B.bin"), '1;2']) as output:
+            self.assertTrue("not a square matrix" in output)
+        with capture_stderr(main, ["--A-file", self.path("A.npy"), '1;2;3', '9;9;9']) as output:
+            self.assertTrue("not both" in output)
+
+    def testSparseVector(self):
+        # a coordinate Matrix Market file gives a sparse matrix, which B must not stay
+        np.save(self.path("A.npy"), self.A)
+        with open(self.path("B.mtx"), "w") as handle:
+            handle.write("%%MatrixMarket matrix coordinate real general\n3 1 3\n1 1 1\n2 1 2\n3 1 3\n")
+        with capture_stdout(main, ["--A-file", self.path("A.npy"), "--B-file", self.path("B.mtx")]) as output:
+            self.assertTrue("[ 0.57739235  0.45109532 -0.32795924]" in output)
+
+
+class TestMatrixMarket(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        if not DISABLE_REMOVE:
+            self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w") as handle:
+            handle.write(text)
+        return path
+
+    def testCoordinate(self):
+        path = self.write("A.mtx", "%%MatrixMarket matrix coordinate real general\n% a comment\n3 3 7\n"
+                                   "1 1 5\n2 1 -3\n3 1 2\n1 2 -2\n2 2 9\n3 2 -1\n3 3 -7e0\n")
+        A = read_matrix_market(path, chunk_bytes=16) # a few lines per chunk
+        self.assertTrue(sp.isspmatrix_csr(A))
+        self.assertTrue(np.array_equal(A.toarray(), [[5., -2., 0.], [-3., 9., 0.], [2., -1., -7.]]))
+
+    def testSymmetry(self):
+        header = "%%MatrixMarket matrix coordinate {} {}\n3 3 4\n"
+        entries = "1 1 4\n2 1 -1\n3 2 -1\n3 3 4\n"
+        A = read_matrix_market(self.write("S.mtx", header.format("real", "symmetric") + entries))
+        self.assertTrue(np.array_equal(A.toarray(), [[4., -1., 0.], [-1., 0., -1.], [0., -1., 4.]]))
+        K = read_matrix_market(self.write("K.mtx", "%%MatrixMarket matrix coordinate real skew-symmetric\n"
+                                                   "3 3 2\n2 1 1\n3 2 2\n"))
+        self.assertTrue(np.array_equal(K.toarray(), [[0., -1., 0.], [1., 0., -2.], [0., 2., 0.]]))
+        P = read_matrix_market(self.write("P.mtx", "%%MatrixMarket matrix coordinate pattern symmetric\n"
+                                                   "2 2 2\n1 1\n2 1\n"))
+        self.assertTrue(np.array_equal(P.toarray(), [[1., 1.], [1., 0.]]))
+
+    def testArray(self):
+        A = read_matrix_market(self.write("A.mtx", "%%MatrixMarket matrix array real general\n2 2\n1\n2\n3\n4\n"))
+        self.assertTrue(np.array_equal(A, [[1., 3.], [2., 4.]]))
+        S = read_matrix_market(self.write("S.mtx", "%%MatrixMarket matrix array real symmetric\n2 2\n1\n2\n4\n"))
+        self.assertTrue(np.array_equal(S, [[1., 2.], [2., 4.]]))
+
+    def testInvalid(self):
+        with self.assertRaises(ValueError):
+            read_matrix_market(self.write("C.mtx", "%%MatrixMarket matrix coordinate complex general\n"
+                                                   "1 1 1\n1 1 1 0\n"))
+        with self.assertRaises(ValueError):
+            read_matrix_market(self.write("S.mtx", "%%MatrixMarket matrix coordinate real general\n2 2 3\n1 1 1\n"))
+
+    def testCommandLine(self):
+        path = self.write("A.mtx", "%%MatrixMarket matrix coordinate real general\n3 3 9\n1 1 5\n2 1 -3\n3 1 2\n"
+                                   "1 2 -2\n2 2 9\n3 2 -1\n1 3 3\n2 3 1\n3 3 -7\n")
+        with capture_stdout(main, ["--A-file", path, '1;2;3']) as output:
+            self.assertTrue("[ 0.57739235  0.45109532 -0.32795924]" in output)
+
+
+class TestOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        if not DISABLE_REMOVE:
+            self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.x = np.array([[0.5, 1.], [-2., 3.]])
+
+    def testFormats(self):
+        for name, fmt in (("x.npy", None), ("x.bin", None), ("x.npy", "memmap"), ("x.out", "raw")):
+            path = os.path.join(self.tmp_dir, name)
+            write_array(path, self.x, fmt)
+            if fmt == "raw" or (fmt is None and name.endswith(".bin")):
+                self.assertTrue(np.array_equal(np.fromfile(path, dtype="<f8").reshape(2, 2), self.x))
+            else:
+                self.assertTrue(np.array_equal(np.load(path, mmap_mode="r"), self.x))
+        with self.assertRaises(ValueError):
+            write_array(os.path.join(self.tmp_dir, "x.npy"), self.x, "text")
+
+    def testJsonRecord(self):
+        test_input = ["--json", "-s", "s", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            record = json.loads(output)
+        self.assertEqual((record["method"], record["omega"], record["converged"]), ("gauss-siedel", 1.6, True))
+        self.assertTrue(np.allclose(record["x"], [0.5776533, 0.45030048, -0.32795644]))
+        self.assertTrue(record["iterations"] > 0 and record["residual"] <= 0.01)
+        self.assertTrue(set(record["timings"]) >= {"read", "solve"})
+
+    def testStrictJson(self):
+        # NaN is not JSON; a singular system reports null instead
+        test_input = ["--json", "-s", "d", '1,2;2,4', '1;1']
+        with capture_stdout(main, test_input) as output:
+            record = json.loads(output, parse_constant=self.fail)
+        self.assertEqual((record["reason"], record["residual"], record["x"]), ("singular", None, [None, None]))
+
+    def testScalingReportInRecord(self): # stdout must stay one JSON record per line
+        test_input = ["--json", "--scaling", "ruiz", "--scaling-report", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            lines = output.splitlines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record["scaled_iterations"], record["iterations"])
+        self.assertTrue(record["unscaled_iterations"] > 0)
+
+    def testRejectedRecord(self):
+        with capture_stdout(main, ["--json", '1,2,3;3,1,2;2,3,1', '1;1;1']) as output:
+            record = json.loads(output)
+        self.assertFalse(record["converged"])
+        self.assertTrue("diagonally dominant" in record["error"])
+
+    def testOutputFile(self):
+        path = os.path.join(self.tmp_dir, "x.npy")
+        test_input = ["--json", "--output", path, "-s", "d", '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']
+        with capture_stdout(main, test_input) as output:
+            record = json.loads(output)
+        self.assertEqual((record["method"], record["output"]), ("lu", path))
+        self.assertFalse("x" in record)
+        self.assertTrue(np.allclose(np.load(path), [0.57728707, 0.4511041, -0.32807571]))
+        with capture_stdout(main, ["--output", path, '5,-2,3;-3,9,1;2,-1,-7', '1;2;3']) as output:
+            self.assertTrue("written to" in output)
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        if not DISABLE_REMOVE:
+            self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.A = np.array([[5., -2., 3.], [-3., 9., 1.], [2., -1., -7.]])
+        self.B = np.array([1., 2., 3.])
+
+    def testNdjson(self):
+        path = os.path.join(self.tmp_dir, "systems.ndjson")
+        with open(path, "w") as f:
+            f.write('{"id": "text", "A": "5,-2,3;-3,9,1;2,-1,-7", "B": [1, 2, 3]}\n\n')
+            f.write('{"A": [[1, 3], [3, 1]], "B": [1, 2], "x0": [0, 0]}\nnot json\n{"B": [1]}\n')
+        systems = list(read_systems(path))
+        self.assertEqual([system.id for system in systems], ["text", 3, 4, 5])
+        self.assertTrue(np.array_equal(systems[0].A, self.A))
+        self.assertEqual(systems[1].x0.shape, (2,))
+        self.assertTrue(systems[2].error is not None and "has no A" in systems[3].error)
+
+    def testArchives(self):
+        np.savez(os.path.join(self.tmp_dir, "a.npz"), A=np.stack([self.A, 2*self.A]), B=np.stack([self.B, self.B]))
+        np.savez(os.path.join(self.tmp_dir, "b.npz"), A_one=self.A, B_one=self.B, A_two=self.A)
+        systems = list(read_systems(self.tmp_dir))
+        self.assertEqual([system.id for system in systems], ["a/0", "a/1", "b/one", "b/two"])
+        self.assertTrue(np.array_equal(systems[1].A, 2*self.A))
+        self.assertTrue(systems[3].error is not None)
+        self.assertEqual(len(list(read_systems(os.path.join(self.tmp_dir, "b.npz")))), 2)
+
+    def testSolveInOrder(self):
+        systems = [BatchSystem(k, self.A*(k + 1), self.B, None, None) for k in range(20)]
+        systems.insert(5, BatchSystem("bad", None, None, None, "could not read it"))
+        systems.append(BatchSystem("singular", np.array([[1., 3.], [3., 1.]]), np.ones(2), None, None))
+        out = io.StringIO()
+        count, failed = solve_systems(iter(systems), "s", out=out, depth=2)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual((count, failed), (22, 1))
+        self.assertEqual([record["id"] for record in records], [system.id for system in systems])
+        self.assertEqual(records[5]["error"], "could not read it")
+        self.assertTrue(np.allclose(records[0]["x"], [0.5776533, 0.45030048, -0.32795644]))
+        self.assertEqual(records[0]["method"], "gauss-siedel")
+        # the rows of the last system are swapped to make it diagonally dominant
+        self.assertTrue(np.allclose(np.dot(systems[-1].A, records[-1]["x"]), 1, atol=0.02))
+
+    def testBadSystems(self):
+        # a system that cannot be read or solved gets an error record, and the systems around it are still solved
+        path = os.path.join(self.tmp_dir, "systems.ndjson")
+        with open(path, "w") as f:
+            f.write('{"id": "a", "A": [[4, 1], [1, 3]], "B": [1, 2]}\n{"A": {"x": 1}, "B": [1, 2]}\n')
+            f.write('{"A": [[4, 1], [1, 3]], "B": 5}\n{"A": [[1, 2, 3], [4, 5, 6]], "B": [1, 2, 3]}\n')
+            f.write('{"id": "z", "A": [[4, 1], [1, 3]], "B": [1, 2]}\n')
+        out = io.StringIO()
+        self.assertEqual(solve_systems(read_systems(path), out=out), (5, 3))
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([record["id"] for record in records], ["a", 2, 3, 4, "z"])
+        self.assertTrue("TypeError" in records[1]["error"] and "B must be" in records[2]["error"])
+        self.assertTrue("must be square" in records[3]["error"])
+        self.assertTrue(records[0]["converged"] and records[4]["converged"])
+
+    def testCommandLine(self):
+        np.savez(os.path.join(self.tmp_dir, "a.npz"), A=np.stack([self.A, self.A]), B=np.stack([self.B, self.B]))
+        output_dir = os.path.join(self.tmp_dir, "answers")
+        test_input = ["batch", "-s", "d", "--output-dir", output_dir, os.path.join(self.tmp_dir, "a.npz")]
+        with capture_stdout(main, test_input) as output:
+            records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([record["method"] for record in records], ["lu", "lu"])
+        self.assertTrue(np.allclose(np.load(records[1]["output"]), [0.57728707, 0.4511041, -0.32807571]))
+        with capture_stderr(main, ["batch", os.path.join(self.tmp_dir, "missing.ndjson")]) as output:
+            self.assertTrue("Could not read the systems" in output)
+
+
 # Utility functions
 
 # From http://schinckel.net/2013/04/15/capture-and-test-sys.stdout-sys.stderr-in-unittest.testcase/